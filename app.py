@@ -2,19 +2,52 @@
 
 import os
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.errors
 import secrets
 import time
 import imghdr
 import bcrypt
 import base64
+import binascii
+import json
 import logging
-from flask import Flask, jsonify, request, send_from_directory
-from psycopg2.extras import RealDictCursor
-from datetime import datetime
-from typing import Dict, List, Tuple, Optional
+import threading
+import heapq
+import hmac
+import hashlib
+import sqlite3
+import tempfile
+import atexit
+import select
+import bisect
+import itertools
+import re
+import io
+import click
+import mimetypes
+from array import array
+from flask import Flask, jsonify, request, send_from_directory, g, has_request_context, Response, stream_with_context
+from psycopg2.extras import RealDictCursor, execute_values
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Tuple, Optional, NamedTuple
+from collections import OrderedDict
 from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
 from dotenv import load_dotenv  # Для загрузки переменных окружения из .env файла
 
+try:
+    import fcntl  # міжпроцесні блокування файлів зображень; на Windows — лише в межах процесу
+except ImportError:
+    fcntl = None
+
+try:
+    from PIL import Image  # Pillow — лише для мініатюр /images/...?w=; без нього віддається оригінал
+except ImportError:
+    Image = None
+
 
 # Если приложение запущено локально, а не в Railway — загружаем переменные из .env
 if os.environ.get("RAILWAY_ENVIRONMENT") is None:
@@ -27,6 +60,14 @@ log = logging.getLogger(__name__)
 bDebug = False
 bDebug2= False
 
+
+def _parse_env_flag(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 # === Константи ===
 VALID_LANGS         = {'ua', 'pl', 'en', 'ru'}
 VALID_CURRENCIES    = {'uah', 'pln', 'usd', 'eur'}
@@ -34,9 +75,71 @@ DEFAULT_LANG        = 'ua'
 DEFAULT_CURRENCY    = 'uah'
 DEFAULT_PAGE_LIMIT  = 50
 MAX_PAGE_LIMIT      = 250
+MAX_BATCH_IDS       = 100   # GET /products?ids=...
 NO_IMAGE_MARKER     = "__NO_IMAGE__"  # Маркер: изображения нет и не нужно искать
 UPLOAD_FOLDER       = "/app/static/images"
 
+# === Пул з'єднань з БД (налаштовується через змінні оточення) ===
+DB_POOL_MIN         = int(os.getenv("DB_POOL_MIN", 1))   # відкриваються при старті; простоюючих тримаємо до DB_POOL_MAX
+DB_POOL_MAX         = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT     = float(os.getenv("DB_POOL_TIMEOUT", 10))       # сек. очікування вільного з'єднання
+DB_POOL_IDLE_CHECK  = float(os.getenv("DB_POOL_IDLE_CHECK", 30))    # після такого простою — перевірка SELECT 1
+DB_POOL_MAX_AGE     = float(os.getenv("DB_POOL_MAX_AGE", 1800))     # старші з'єднання перевідкриваються
+
+# === Кеш довідників (/languages, /currencies) ===
+REFDATA_TTL         = float(os.getenv("REFDATA_TTL", 3600))         # страховка, якщо NOTIFY не дійшов
+REFDATA_CHANNEL     = os.getenv("REFDATA_CHANNEL", "refdata_changed")  # канал LISTEN/NOTIFY (migrations/002_refdata_notify.sql)
+
+# === Версія каталогу та кеш відповідей /products ===
+CATALOG_VERSION_TTL     = float(os.getenv("CATALOG_VERSION_TTL", 5))   # як часто перевіряти версію каталогу в БД
+PRODUCTS_CACHE_MAX_BYTES = int(os.getenv("PRODUCTS_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+PRODUCTS_CACHE_TTL      = float(os.getenv("PRODUCTS_CACHE_TTL", 300))  # шляхи зображень не входять у версію каталогу
+PRODUCTS_CACHE_CONTROL  = os.getenv("PRODUCTS_CACHE_CONTROL", "private, max-age=30")
+
+# === Каталог у пам'яті ===
+CATALOG_ENGINE              = os.getenv("CATALOG_ENGINE", "").lower()   # "memory" — обслуговувати /products з пам'яті
+CATALOG_REFRESH_INTERVAL    = float(os.getenv("CATALOG_REFRESH_INTERVAL", 15))
+CATALOG_REFRESH_OVERLAP     = timedelta(seconds=60)  # перекриття вікна дельти: рядки, закомічені із запізненням
+CATALOG_RECONCILE_INTERVAL  = float(os.getenv("CATALOG_RECONCILE_INTERVAL", 600))  # звірка кількостей / повний список зображень
+
+# === Фільтри та фасети /products ===
+# Межі цінових діапазонів для facets=1: "0,100,500" -> [0..100), [100..500), [500..)
+PRICE_FACET_BOUNDS  = [float(x) for x in os.getenv("PRICE_FACET_BOUNDS", "0,100,500,1000,5000,10000").split(',') if x.strip()]
+
+# === Пошук ===
+SEARCH_MAX_TERMS    = 8     # слів у запиті, решта ігнорується
+SEARCH_MIN_LENGTH   = 2
+
+# === Автодоповнення ===
+SUGGEST_INDEX               = _parse_env_flag("SUGGEST_INDEX", True)   # індекс у пам'яті кожного воркера
+SUGGEST_REFRESH_INTERVAL    = float(os.getenv("SUGGEST_REFRESH_INTERVAL", 30))
+SUGGEST_DEFAULT_LIMIT       = 10
+SUGGEST_MAX_LIMIT           = 50
+SUGGEST_SCAN_LIMIT          = 500   # скільки збігів префікса переглядаємо для ранжування
+
+# === Експорт каталогу ===
+EXPORT_ITERSIZE     = int(os.getenv("EXPORT_ITERSIZE", 500))        # рядків за один FETCH серверного курсора
+EXPORT_MAX_ITERSIZE = 5000
+
+# === Зображення ===
+# background — потік у кожному web-воркері переносить BYTEA у файли; запити лише читають шляхи
+# worker     — те саме робить лише окремий процес `flask images worker`
+# inline     — як раніше: файл пишеться прямо в запиті
+# Окремий процес (worker, `flask images materialize|gc`) обнуляє img_data після запису файлу,
+# тож працює лише з IMAGE_SHARED_VOLUME=1 — коли UPLOAD_FOLDER той самий том, що й у web.
+# На Railway/Heroku кожен процес Procfile має власну файлову систему — там лише background/inline.
+IMAGE_MATERIALIZE       = os.getenv("IMAGE_MATERIALIZE", "background").lower()
+IMAGE_SHARED_VOLUME     = _parse_env_flag("IMAGE_SHARED_VOLUME", False)
+IMAGE_WORKER_INTERVAL   = float(os.getenv("IMAGE_WORKER_INTERVAL", 30))   # сек. між проходами (або раніше — за wake())
+IMAGE_WORKER_BATCH      = int(os.getenv("IMAGE_WORKER_BATCH", 50))        # рядків на транзакцію
+IMAGE_PATH_CACHE_MAX    = int(os.getenv("IMAGE_PATH_CACHE_MAX", 20000))   # ключів (product_code, subprod_code) у пам'яті
+IMAGE_PATH_CACHE_TTL    = float(os.getenv("IMAGE_PATH_CACHE_TTL", 300))   # сек. для шляхів і NO_IMAGE_MARKER
+IMAGE_SENDFILE          = os.getenv("IMAGE_SENDFILE", "").lower()   # "" — віддає Flask; x-accel (nginx) | x-sendfile (apache, lighttpd)
+IMAGE_ACCEL_PREFIX      = os.getenv("IMAGE_ACCEL_PREFIX", "/protected-images")  # internal location nginx -> UPLOAD_FOLDER
+IMAGE_IMMUTABLE_CONTROL = "public, max-age=31536000, immutable"   # для імен з хешем вмісту
+THUMB_WIDTHS            = sorted({int(w) for w in os.getenv("THUMB_WIDTHS", "200,400").split(',') if w.strip()})
+THUMB_WORKERS           = int(os.getenv("THUMB_WORKERS", 2))      # потоків генерації на процес
+
 # === Типи ===
 ImageKey        = Tuple[str, Optional[str]]  # (product_code, subprod_code)
 ImagePathMap    = Dict[ImageKey, str]
@@ -44,6 +147,8 @@ ImagePathMap    = Dict[ImageKey, str]
 
 app = Flask(__name__)
 
+app.config['USE_X_SENDFILE'] = IMAGE_SENDFILE == "x-sendfile"
+
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 
@@ -54,22 +159,577 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 # 🔐 Звичайна база користувачів та токенів
 
 # USERS = {"admin": "1234"}
-# TOKENS = {}  # token -> (username, expiry)
 TOKEN_TTL = 172800  # 48 годин
-# TOKENS["tokenstring"] = [user_id, user_login, user_name, token_expire_date]
-TOKENS = {}
+TOKEN_STORE          = os.getenv("TOKEN_STORE", "sqlite").lower()   # sqlite — спільне для всіх воркерів хоста; memory — як раніше; signed — без стану
+# Ключі для TOKEN_STORE=signed: "kid1:secret1,kid2:secret2". Першим йде активний ключ (ним підписуються нові токени),
+# решта лише приймаються — так ключ ротується без примусового перелогіну.
+TOKEN_SIGNING_KEYS   = os.getenv("TOKEN_SIGNING_KEYS", "")
+# Збереження виданих токенів у Postgres (таблиця auth_tokens, migrations/001_auth_tokens.sql),
+# щоб рестарт/деплой не перетворювався на шквал POST /login. "postgres" — увімкнути, "" — вимкнено.
+TOKEN_PERSIST        = os.getenv("TOKEN_PERSIST", "").lower()
+TOKEN_FLUSH_INTERVAL = float(os.getenv("TOKEN_FLUSH_INTERVAL", 2))   # сек. між пакетними записами
+TOKEN_FLUSH_BATCH    = int(os.getenv("TOKEN_FLUSH_BATCH", 200))      # або раніше, якщо назбиралось стільки
+# Скільки пам'ятати, що токена немає і в БД. Менше за TOKEN_FLUSH_INTERVAL: токен, щойно виданий
+# іншим воркером/хостом, потрапляє в БД лише з наступним flush — довший кеш промаху дав би йому 401.
+TOKEN_MISS_TTL       = min(float(os.getenv("TOKEN_MISS_TTL", 30)), TOKEN_FLUSH_INTERVAL / 2)
+TOKEN_MISS_MAX       = 10000
+TOKEN_DB_PATH        = os.getenv("TOKEN_DB_PATH", os.path.join(tempfile.gettempdir(), "rlwai_tokens.sqlite3"))
+TOKEN_PURGE_INTERVAL = float(os.getenv("TOKEN_PURGE_INTERVAL", 60))  # як часто прибирати прострочені токени
+
+
+class TokenInfo(NamedTuple):
+    user_id     : int
+    user_login  : str
+    user_name   : str
+    expires_at  : float
+
+
+class MemoryTokenStore:
+    """
+    Токени в пам'яті процесу: dict для O(1) пошуку + купа (expires_at, token)
+    для проактивного видалення прострочених записів.
+    """
+
+    def __init__(self):
+        self._tokens: Dict[str, TokenInfo] = {}
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self._lock = threading.Lock()
+        self._next_purge = 0.0
+
+    def issue(self, user_id: int, user_login: str, user_name: str, ttl: float = TOKEN_TTL) -> str:
+        token = secrets.token_hex(16)
+        self.put(token, TokenInfo(user_id, user_login, user_name, time.time() + ttl))
+        return token
+
+    def put(self, token: str, info: TokenInfo):
+        with self._lock:
+            self._tokens[token] = info
+            heapq.heappush(self._expiry_heap, (info.expires_at, token))
+        self._maybe_purge()
+
+    def get(self, token: str) -> Optional[TokenInfo]:
+        self._maybe_purge()
+        return self._tokens.get(token)
+
+    def discard(self, token: str):
+        with self._lock:
+            self._tokens.pop(token, None)  # запис у купі видалиться при наступному purge
+
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            while self._expiry_heap and self._expiry_heap[0][0] <= now:
+                expires_at, token = heapq.heappop(self._expiry_heap)
+                info = self._tokens.get(token)
+                if info is not None and info.expires_at <= now:
+                    del self._tokens[token]
+
+    def _maybe_purge(self):
+        now = time.time()
+        if now >= self._next_purge:
+            self._next_purge = now + TOKEN_PURGE_INTERVAL
+            self.purge()
+
+
+class SqliteTokenStore:
+    """
+    Токени у спільному для всіх воркерів хоста файлі SQLite (WAL: читачі не блокують запис).
+    Перед файлом — MemoryTokenStore як локальний кеш, тож повторні перевірки
+    того самого токена в require_auth лишаються O(1) без звернення до SQLite.
+    Прострочені записи видаляються пакетно по індексу expires_at.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._local = threading.local()
+        self._cache = MemoryTokenStore()
+        self._next_purge = 0.0
+        self._db().executescript("""
+            CREATE TABLE IF NOT EXISTS tokens (
+                token       BLOB PRIMARY KEY,
+                user_id     INTEGER NOT NULL,
+                user_login  TEXT NOT NULL,
+                user_name   TEXT NOT NULL,
+                expires_at  REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS tokens_expires_at ON tokens (expires_at);
+        """)
+
+    def _db(self) -> sqlite3.Connection:
+        # окреме з'єднання на потік і на процес (після fork старе не використовуємо)
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self._path, timeout=5, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @staticmethod
+    def _key(token: str) -> Optional[bytes]:
+        # token_hex(16) -> 16 байт замість 32 символів
+        try:
+            return bytes.fromhex(token)
+        except ValueError:
+            return None
+
+    def issue(self, user_id: int, user_login: str, user_name: str, ttl: float = TOKEN_TTL) -> str:
+        token = secrets.token_hex(16)
+        self.put(token, TokenInfo(user_id, user_login, user_name, time.time() + ttl))
+        return token
+
+    def put(self, token: str, info: TokenInfo):
+        key = self._key(token)
+        if key is None:
+            return
+        self._db().execute(
+            "INSERT OR REPLACE INTO tokens (token, user_id, user_login, user_name, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (key, *info))
+        self._cache.put(token, info)
+        self._maybe_purge()
+
+    def get(self, token: str) -> Optional[TokenInfo]:
+        info = self._cache.get(token)
+        if info is not None:
+            return info
+
+        key = self._key(token)
+        if key is None:
+            return None
+        row = self._db().execute(
+            "SELECT user_id, user_login, user_name, expires_at FROM tokens WHERE token = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        info = TokenInfo(*row)
+        self._cache.put(token, info)
+        return info
+
+    def discard(self, token: str):
+        self._cache.discard(token)
+        key = self._key(token)
+        if key is not None:
+            self._db().execute("DELETE FROM tokens WHERE token = ?", (key,))
+
+    def purge(self):
+        self._cache.purge()
+        self._db().execute("DELETE FROM tokens WHERE expires_at <= ?", (time.time(),))
+
+    def _maybe_purge(self):
+        now = time.time()
+        if now >= self._next_purge:
+            self._next_purge = now + TOKEN_PURGE_INTERVAL
+            try:
+                self.purge()
+            except sqlite3.Error as e:
+                log.warning(f"Token purge failed: {e}")
+
+
+class SignedTokenStore:
+    """
+    Токен без стану на сервері: "v1.<kid>.<payload>.<signature>",
+    payload — base64url від JSON [user_id, user_login, user_name, expires_at],
+    signature — HMAC-SHA256 від "v1.<kid>.<payload>".
+    Перевірка — лише порівняння підпису за сталий час, спільне сховище не потрібне.
+    """
+
+    VERSION = "v1"
+
+    def __init__(self, keys_spec: str):
+        self._keys: Dict[str, bytes] = {}
+        self._active_kid: Optional[str] = None
+        for part in keys_spec.split(','):
+            kid, sep, secret = part.strip().partition(':')
+            if not sep or not kid or not secret or '.' in kid:
+                continue
+            self._keys[kid] = secret.encode('utf-8')
+            if self._active_kid is None:
+                self._active_kid = kid
+        if self._active_kid is None:
+            raise ValueError("TOKEN_SIGNING_KEYS is empty or malformed")
+
+    @staticmethod
+    def _b64encode(raw: bytes) -> str:
+        return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def _b64decode(text: str) -> bytes:
+        return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+    def _sign(self, kid: str, signing_input: str) -> str:
+        digest = hmac.new(self._keys[kid], signing_input.encode('ascii'), hashlib.sha256).digest()
+        return self._b64encode(digest)
+
+    def issue(self, user_id: int, user_login: str, user_name: str, ttl: float = TOKEN_TTL) -> str:
+        raw = json.dumps([user_id, user_login, user_name, int(time.time() + ttl)],
+                         ensure_ascii=False, separators=(',', ':'))
+        signing_input = f"{self.VERSION}.{self._active_kid}.{self._b64encode(raw.encode('utf-8'))}"
+        return f"{signing_input}.{self._sign(self._active_kid, signing_input)}"
+
+    def get(self, token: str) -> Optional[TokenInfo]:
+        # Не-ASCII у підписі/payload інакше кидає UnicodeEncodeError / TypeError (500 замість 401)
+        if not token.isascii():
+            return None
+        parts = token.split('.')
+        if len(parts) != 4 or parts[0] != self.VERSION or parts[1] not in self._keys:
+            return None
+
+        signing_input, signature = token.rsplit('.', 1)
+        if not hmac.compare_digest(self._sign(parts[1], signing_input), signature):
+            return None
+
+        try:
+            user_id, user_login, user_name, expires_at = json.loads(self._b64decode(parts[2]).decode('utf-8'))
+        except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+            return None
+        return TokenInfo(user_id, user_login, user_name, float(expires_at))
+
+    def discard(self, token: str):
+        pass  # відкликати підписаний токен неможливо — він просто спливає
+
+    def purge(self):
+        pass
+
+
+class PersistentTokenStore:
+    """
+    Обгортка над MemoryTokenStore/SqliteTokenStore з write-behind у Postgres:
+    нові токени складаються в чергу і записуються пакетами фоновим потоком,
+    а при промаху в require_auth токен ліниво підтягується з БД.
+    У БД зберігається лише sha256 від токена.
+    """
+
+    def __init__(self, inner):
+        self._inner = inner
+        self._pending: List[Tuple[bytes, TokenInfo]] = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher_pid: Optional[int] = None
+        self._misses: "OrderedDict[str, float]" = OrderedDict()  # token -> до якого часу вважаємо відсутнім
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _hash(token: str) -> bytes:
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def issue(self, user_id: int, user_login: str, user_name: str, ttl: float = TOKEN_TTL) -> str:
+        token = self._inner.issue(user_id, user_login, user_name, ttl)
+        info = self._inner.get(token)
+        with self._lock:
+            self._pending.append((self._hash(token), info))
+            batch_ready = len(self._pending) >= TOKEN_FLUSH_BATCH
+        self._ensure_flusher()
+        if batch_ready:
+            self._wakeup.set()
+        return token
+
+    def get(self, token: str) -> Optional[TokenInfo]:
+        info = self._inner.get(token)
+        if info is not None:
+            return info
+
+        now = time.time()
+        with self._lock:
+            miss_until = self._misses.get(token)
+            if miss_until is not None and miss_until > now:
+                return None
+
+        info = self._load(token)
+        if info is not None:
+            self._inner.put(token, info)
+            return info
+
+        with self._lock:
+            self._misses[token] = now + TOKEN_MISS_TTL
+            self._misses.move_to_end(token)
+            while len(self._misses) > TOKEN_MISS_MAX:
+                self._misses.popitem(last=False)
+        return None
+
+    def discard(self, token: str):
+        self._inner.discard(token)  # прострочені рядки в БД прибирає flush()
+
+    def purge(self):
+        self._inner.purge()
+
+    def _load(self, token: str) -> Optional[TokenInfo]:
+        try:
+            with db_connection() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    SELECT user_id, user_login, user_name, EXTRACT(EPOCH FROM expires_at)
+                    FROM public.auth_tokens
+                    WHERE token_hash = %s AND expires_at > now()
+                """, (self._hash(token),))
+                row = cur.fetchone()
+        except Exception as e:
+            log.warning(f"Token rehydration failed: {e}")
+            return None
+        return TokenInfo(row[0], row[1], row[2], float(row[3])) if row else None
+
+    def _ensure_flusher(self):
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid != os.getpid():
+                self._flusher_pid = os.getpid()
+                threading.Thread(target=self._flush_loop, name="token-flusher", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(TOKEN_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        try:
+            with db_connection(shared=False) as conn:
+                with conn.cursor() as cur:
+                    execute_values(cur, """
+                        INSERT INTO public.auth_tokens (token_hash, user_id, user_login, user_name, expires_at)
+                        VALUES %s
+                        ON CONFLICT (token_hash) DO NOTHING
+                    """, [(psycopg2.Binary(h), *info[:3], info.expires_at) for h, info in batch],
+                        template="(%s, %s, %s, %s, to_timestamp(%s))")
+                    cur.execute("DELETE FROM public.auth_tokens WHERE expires_at <= now()")
+                conn.commit()
+        except Exception as e:
+            log.error(f"Token flush failed ({len(batch)} tokens): {e}")
+            with self._lock:
+                # спробуємо наступного разу, але не накопичуємо чергу безкінечно
+                if len(self._pending) < TOKEN_FLUSH_BATCH * 50:
+                    self._pending[:0] = batch
+
+
+def _create_token_store():
+    if TOKEN_STORE == "signed":
+        try:
+            return SignedTokenStore(TOKEN_SIGNING_KEYS)
+        except ValueError as e:
+            log.error(f"Signed tokens unavailable: {e}; falling back to {TOKEN_DB_PATH}")
+
+    store = None
+    if TOKEN_STORE in ("sqlite", "signed"):
+        try:
+            store = SqliteTokenStore(TOKEN_DB_PATH)
+        except sqlite3.Error as e:
+            log.error(f"SQLite token store unavailable ({TOKEN_DB_PATH}): {e}; falling back to memory")
+    if store is None:
+        store = MemoryTokenStore()
+
+    if TOKEN_PERSIST == "postgres":
+        return PersistentTokenStore(store)
+    return store
+
+
+# token -> TokenInfo(user_id, user_login, user_name, expires_at)
+TOKENS = _create_token_store()
 
 
 
 # ==============================================================
 # --------------------------------------------------------------
-# 💾 Функція підключення до БД, викликається з кожного маршруту, де потрібно звертатися до бази
+# 💾 Підключення до БД
 
-def get_db_connection():
+def _get_database_url() -> str:
     db_url = os.getenv("DATABASE_URL")  # Читаем URL базы из переменной окружения
     if not db_url:
         raise RuntimeError("DATABASE_URL не задана.")
-    return psycopg2.connect(db_url)
+    return db_url
+
+
+def get_db_connection():
+    """
+    Окреме (не з пулу) з'єднання. Маршрути мають використовувати db_connection().
+    """
+    return psycopg2.connect(_get_database_url())
+
+
+class _KeepIdleConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    Базовий _putconn закриває кожне повернуте з'єднання понад minconn, тож при паралельних
+    запитах пул щоразу підключався б заново. Тут простоюючих тримаємо до maxconn
+    (BoundedSemaphore у _checkout_db_connection не дає взяти більше).
+    putconn викликає _putconn під self._lock, тож тимчасова заміна minconn безпечна.
+    """
+
+    def _putconn(self, conn, key=None, close=False):
+        minconn = self.minconn
+        self.minconn = self.maxconn
+        try:
+            super()._putconn(conn, key, close)
+        finally:
+            self.minconn = minconn
+            if conn.closed:
+                _db_conn_meta.pop(id(conn), None)  # id() може дістатися новому з'єднанню
+
+
+# Пул створюється ліниво в кожному процесі, тобто вже після fork воркера gunicorn.
+# З'єднання, успадковані від батьківського процесу, ніколи не використовуються повторно.
+_db_pool: Optional[_KeepIdleConnectionPool] = None
+_db_pool_pid: Optional[int] = None
+_db_pool_slots: Optional[threading.BoundedSemaphore] = None
+_db_pool_lock = threading.Lock()
+_db_conn_meta: Dict[int, Tuple[float, float]] = {}  # id(conn) -> (created_at, last_used)
+
+
+def _reset_db_pool_after_fork():
+    """Дочірній процес забуває пул батька (сокети не закриваємо — вони належать батьку)."""
+    global _db_pool, _db_pool_pid, _db_pool_slots, _db_pool_lock
+    _db_pool = None
+    _db_pool_pid = None
+    _db_pool_slots = None
+    _db_pool_lock = threading.Lock()
+    _db_conn_meta.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_db_pool_after_fork)
+
+
+def _get_db_pool() -> _KeepIdleConnectionPool:
+    global _db_pool, _db_pool_pid, _db_pool_slots
+    pid = os.getpid()
+    if _db_pool is not None and _db_pool_pid == pid:
+        return _db_pool
+
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool_pid != pid:
+            _db_conn_meta.clear()
+            _db_pool = _KeepIdleConnectionPool(DB_POOL_MIN, DB_POOL_MAX, _get_database_url())
+            _db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+            _db_pool_pid = pid
+            log.info(f"DB pool created: pid={pid}, min={DB_POOL_MIN}, max={DB_POOL_MAX}")
+    return _db_pool
+
+
+def _is_connection_usable(conn) -> bool:
+    """Відсіює закриті, застарілі та «мертві» після довгого простою з'єднання."""
+    if conn.closed:
+        return False
+
+    now = time.monotonic()
+    created_at, last_used = _db_conn_meta.setdefault(id(conn), (now, now))
+    if now - created_at > DB_POOL_MAX_AGE:
+        return False
+
+    if now - last_used > DB_POOL_IDLE_CHECK:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+    return True
+
+
+def _checkout_db_connection():
+    pool = _get_db_pool()
+    slots = _db_pool_slots
+
+    # ThreadedConnectionPool не чекає на вільне з'єднання, а одразу кидає PoolError
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.pool.PoolError("connection pool exhausted")
+
+    try:
+        for _ in range(DB_POOL_MAX + 1):
+            conn = pool.getconn()
+            if _is_connection_usable(conn):
+                return conn
+            _db_conn_meta.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+        raise psycopg2.pool.PoolError("no usable connection in pool")
+    except Exception:
+        slots.release()
+        raise
+
+
+def _checkin_db_connection(conn):
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            # незавершена транзакція відкочується, налаштування скидаються
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+        except psycopg2.Error:
+            broken = True
+
+    if broken:
+        _db_conn_meta.pop(id(conn), None)
+    elif id(conn) in _db_conn_meta:
+        _db_conn_meta[id(conn)] = (_db_conn_meta[id(conn)][0], time.monotonic())
+
+    if _db_pool is not None and _db_pool_pid == os.getpid():
+        try:
+            _db_pool.putconn(conn, close=broken)
+        finally:
+            _db_pool_slots.release()
+    else:
+        conn.close()
+
+
+@contextmanager
+def db_connection(shared: bool = True):
+    """
+    Видає з'єднання з пулу та повертає його туди після блоку with.
+    В межах HTTP-запиту вкладені виклики (_fetch_image_paths_bulk, save_image_to_file, ...)
+    отримують те саме з'єднання, що й маршрут. shared=False — окреме з'єднання.
+    """
+    bind = shared and has_request_context()
+    if bind and g.get('_db_conn') is not None:
+        yield g._db_conn
+        return
+
+    conn = _checkout_db_connection()
+    if bind:
+        g._db_conn = conn
+    try:
+        yield conn
+    finally:
+        if bind:
+            g.pop('_db_conn', None)
+        _checkin_db_connection(conn)
+
+
+# ==============================================================
+# --------------------------------------------------------------
+# ⚙️ Разова ініціалізація воркера
+#    Виконується на першому запиті в кожному процесі, тобто вже після fork gunicorn:
+#    прогріває кеші та запускає фонові потоки.
+_worker_pid: Optional[int] = None
+_worker_init_lock = threading.Lock()
+
+
+@app.before_request
+def _init_worker():
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+
+    with _worker_init_lock:
+        if _worker_pid == os.getpid():
+            return
+        _worker_pid = os.getpid()
+        log.info(f"Worker init: pid={_worker_pid}")
+
+        _warm_refdata()
+        threading.Thread(target=_refdata_listener, name="refdata-listener", daemon=True).start()
+
+        if _catalog_engine is not None:
+            threading.Thread(target=_catalog_engine.run, name="catalog-engine", daemon=True).start()
+
+        if _suggest_index is not None:
+            threading.Thread(target=_suggest_index.run, name="suggest-index", daemon=True).start()
+
+        if IMAGE_MATERIALIZE == "background":
+            threading.Thread(target=_image_materializer.run, name="image-materializer", daemon=True).start()
 
 
 # ==============================================================
@@ -83,20 +743,14 @@ def require_auth(f):
             return jsonify({"error": "Authorization header missing"}), 401
 
         token = auth.split(' ')[1]
-        # user_data = TOKENS.get(token)
-        if token in TOKENS:
-            user_data = TOKENS[token]
-        else:
+        user_data = TOKENS.get(token)
+        if user_data is None:
             return jsonify({"error": "Invalid or expired token"}), 401
 
-        # if not user_data:
-        #    return jsonify({"error": "Invalid or expired token"}), 401
-
-        # username, expiry = user_data
         user_id, user_login, user_name, token_expire_date = user_data
 
         if time.time() > token_expire_date:
-            del TOKENS[token]
+            TOKENS.discard(token)
             return jsonify({"error": "Token expired"}), 401
 
         request.user_id     = user_id
@@ -129,28 +783,23 @@ def login():
     log.debug(f"    try : username:{str(username)}; password:{str(password)}")
 
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        sql = """
-            SELECT usr.id, usr.login, usr.first_name, usr.last_name, usr.phone
-            FROM customers usr
-            WHERE usr.enabled = true and usr.login = %s and usr.phrase = %s"""
-
-        params = [username, password]
-        cur.execute(sql, params)
-        row = cur.fetchone()
-        rows_count = cur.rowcount
-        cur.close()
-        conn.close()
+        with db_connection() as conn, conn.cursor() as cur:
+            sql = """
+                SELECT usr.id, usr.login, usr.first_name, usr.last_name, usr.phone
+                FROM customers usr
+                WHERE usr.enabled = true and usr.login = %s and usr.phrase = %s"""
+
+            params = [username, password]
+            cur.execute(sql, params)
+            row = cur.fetchone()
+            rows_count = cur.rowcount
 
         log.debug(f'    data fetched: {row}')
 
         if rows_count == 1:
-            token = secrets.token_hex(16)
-            TOKENS[token] = [row[0], row[1], row[2] + " " + row[3], time.time() + TOKEN_TTL]
+            token = TOKENS.issue(row[0], row[1], row[2] + " " + row[3], TOKEN_TTL)
             
-            log.debug(f'    TOKEN Result: {TOKENS[token]}')
+            log.debug(f'    TOKEN Result: {TOKENS.get(token)}')
             
             return jsonify(
                 {
@@ -165,40 +814,141 @@ def login():
     except Exception as e:
         log.error(f"Error fetching feedbacks: {e}", exc_info=True)
         return jsonify({"error": "Internal server error"}), 500
-    finally:
-        if conn:
-            conn.close()
 
 
 
 # ==============================================================
 # --------------------------------------------------------------
-@app.route("/languages")
-@require_auth
-def get_languages():
+# 📚 Кеш довідників (мови, валюти) у пам'яті воркера
+#    Відповіді зберігаються вже серіалізованими (bytes) разом зі строгим ETag,
+#    тож умовний запит повертає 304 без звернення до БД і без jsonify.
+#    Скидається через LISTEN/NOTIFY (REFDATA_CHANNEL) або після REFDATA_TTL.
 
-    print(f'+++/languages: user: {str(request.user_id)}')
+_refdata_cache: Dict[str, Tuple[bytes, str, float]] = {}  # key -> (body, etag, loaded_at)
+_refdata_lock = threading.Lock()
 
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+
+def _load_languages() -> dict:
+    with db_connection() as conn, conn.cursor() as cur:
         cur.execute("SELECT code, title FROM public.languages ORDER BY title;")
         rows = cur.fetchall()
         rows_count = cur.rowcount
-        cur.close()
-        conn.close()
 
-        datarows = [
-            {"code": row[0].strip(), "title": row[1]}
-            for row in rows
-        ]
+    datarows = [
+        {"code": row[0].strip(), "title": row[1]}
+        for row in rows
+    ]
 
-        data = {
-            "count": rows_count,
-            "languages": datarows
-        }
+    return {
+        "count": rows_count,
+        "languages": datarows
+    }
 
-        return jsonify(data), 200
+
+def _load_currencies(lang: str) -> dict:
+    col_title = 'title_' + lang
+
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT code, " + col_title + " FROM public.currencies ORDER BY code;")
+
+        rows = cur.fetchall()
+        rows_count = cur.rowcount
+
+    datarows = [
+        {"code": row[0].strip(), "title": row[1]}
+        for row in rows
+    ]
+
+    return {
+        "count": rows_count,
+        "currencies": datarows
+    }
+
+
+def _serialize_json(data) -> Tuple[bytes, str]:
+    """Серіалізує так само, як jsonify, і повертає (body, etag)."""
+    body = (app.json.dumps(data) + "\n").encode('utf-8')
+    return body, hashlib.sha1(body).hexdigest()
+
+
+def _json_bytes_response(body: bytes, etag: str, cache_control: str = "private, no-cache") -> Response:
+    """Готова JSON-відповідь з ETag; якщо клієнт уже має цю версію — 304 без тіла."""
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(body, status=200, mimetype='application/json')
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = cache_control
+    return resp
+
+
+def _refdata_response(key: str, loader) -> Response:
+    entry = _refdata_cache.get(key)
+    if entry is None or time.time() - entry[2] > REFDATA_TTL:
+        body, etag = _serialize_json(loader())
+        entry = (body, etag, time.time())
+        with _refdata_lock:
+            _refdata_cache[key] = entry
+    return _json_bytes_response(entry[0], entry[1])
+
+
+def _invalidate_refdata():
+    with _refdata_lock:
+        _refdata_cache.clear()
+    log.info("Reference data cache invalidated")
+
+
+def _warm_refdata():
+    """Прогрів кешу при старті воркера."""
+    try:
+        _refdata_cache['languages'] = (*_serialize_json(_load_languages()), time.time())
+        for lang in VALID_LANGS:
+            _refdata_cache['currencies:' + lang] = (*_serialize_json(_load_currencies(lang)), time.time())
+    except Exception as e:
+        log.warning(f"Reference data warm-up failed: {e}")
+
+
+def _refdata_listener():
+    """Фоновий потік: LISTEN на окремому з'єднанні поза пулом, при NOTIFY — скидання кешу."""
+    reconnect = False
+    while True:
+        conn = None
+        try:
+            conn = get_db_connection()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f'LISTEN "{REFDATA_CHANNEL}";')
+            if reconnect:
+                # поки з'єднання не було, могли пропустити повідомлення
+                _invalidate_refdata()
+            reconnect = True
+
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    _invalidate_refdata()
+
+        except Exception as e:
+            log.warning(f"Reference data listener error: {e}; reconnecting")
+            time.sleep(5)
+        finally:
+            if conn:
+                conn.close()
+
+
+# ==============================================================
+# --------------------------------------------------------------
+@app.route("/languages")
+@require_auth
+def get_languages():
+
+    print(f'+++/languages: user: {str(request.user_id)}')
+
+    try:
+        return _refdata_response('languages', _load_languages)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -216,29 +966,8 @@ def get_currencies():
     if lang not in ['ua', 'pl', 'en', 'ru']:
         lang = 'ua'
 
-    col_title = 'title_' + lang
-
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT code, " + col_title + " FROM public.currencies ORDER BY code;")
-
-        rows = cur.fetchall()
-        rows_count = cur.rowcount
-        cur.close()
-        conn.close()
-
-        datarows = [
-            {"code": row[0].strip(), "title": row[1]}
-            for row in rows
-        ]
-
-        data = {
-            "count": rows_count,
-            "currencies": datarows
-        }
-
-        return jsonify(data), 200
+        return _refdata_response('currencies:' + lang, lambda: _load_currencies(lang))
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -265,17 +994,16 @@ def create_feedback():
         return jsonify({"error": "Feedback too long (max 500 characters)"}), 400
 
     # === Сохранение ===
-    conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO public.feedbacks (customer_id, "date", feedback)
-                VALUES (%s, %s, %s)
-                RETURNING id
-            """, (user_id, datetime.utcnow(), feedback_text))
-            feedback_id = cur.fetchone()[0]
-        conn.commit()
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO public.feedbacks (customer_id, "date", feedback)
+                    VALUES (%s, %s, %s)
+                    RETURNING id
+                """, (user_id, datetime.utcnow(), feedback_text))
+                feedback_id = cur.fetchone()[0]
+            conn.commit()
 
         log.info(f"Feedback created: id={feedback_id}, user={user_id}")
         return jsonify({
@@ -284,16 +1012,28 @@ def create_feedback():
         }), 201
 
     except Exception as e:
+        # незакомічена транзакція відкочується при поверненні з'єднання в пул
         log.error(f"Error creating feedback: {e}", exc_info=True)
-        if conn:
-            conn.rollback()
         return jsonify({"error": "Internal server error"}), 500
-    finally:
-        if conn:
-            conn.close()
 
 
 
+# ==============================================================
+# --------------------------------------------------------------
+# 🔧 Розбір параметрів запиту
+
+def _parse_bool_arg(value: Optional[str]) -> Optional[bool]:
+    """'1'/'true'/'yes' -> True, '0'/'false'/'no' -> False, відсутній або інший -> None"""
+    if value is None:
+        return None
+    value = value.strip().lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('0', 'false', 'no', 'off'):
+        return False
+    return None
+
+
 # ==============================================================
 # --------------------------------------------------------------
 # 📗 Запит товарних категорій
@@ -312,33 +1052,53 @@ def get_categories():
 
     col_title = 'title_' + lang
 
+    # active_only=1 — рахувати лише активні товари (за замовчуванням — всі, як і раніше)
+    active_only = _parse_bool_arg(request.args.get('active_only')) or False
+
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT 
-              c.id, 
-              c.code, 
-              c.""" + col_title + """, 
-              COUNT(p.id) as ProductCount
-            FROM 
-                Categories c
-            LEFT JOIN 
-                Products p ON c.code = p.category_code
-            GROUP BY 
-                c.id, c."""+col_title+""" 
-            ORDER BY c.code;""")
+        with db_connection() as conn, conn.cursor() as cur:
+            try:
+                # Лічильники ведуться тригером (migrations/003_category_product_counts.sql) — O(#категорій)
+                cur.execute("""
+                    SELECT 
+                      c.id, 
+                      c.code, 
+                      c.""" + col_title + """, 
+                      COALESCE(cnt.total_count, 0),
+                      COALESCE(cnt.active_count, 0)
+                    FROM 
+                        Categories c
+                    LEFT JOIN 
+                        category_product_counts cnt ON cnt.category_code = c.code
+                    ORDER BY c.code;""")
+            except psycopg2.errors.UndefinedTable:
+                # міграцію ще не застосовано — рахуємо агрегатом, як раніше
+                conn.rollback()
+                log.warning("category_product_counts is missing, falling back to COUNT(...) GROUP BY")
+                cur.execute("""
+                    SELECT 
+                      c.id, 
+                      c.code, 
+                      c.""" + col_title + """, 
+                      COUNT(p.id) as ProductCount,
+                      COUNT(p.id) FILTER (WHERE p.is_active) as ActiveCount
+                    FROM 
+                        Categories c
+                    LEFT JOIN 
+                        Products p ON c.code = p.category_code
+                    GROUP BY 
+                        c.id, c."""+col_title+""" 
+                    ORDER BY c.code;""")
 
-        rows = cur.fetchall()
-        rows_count = cur.rowcount
-        cur.close()
-        conn.close()
+            rows = cur.fetchall()
+            rows_count = cur.rowcount
 
         if bDebug2:
             print(f'    data fetched: {str(rows_count)} rows')
 
         datarows = [
-            {"id": row[0], "code": row[1].strip(), "title": row[2], "prod_count": row[3]}
+            {"id": row[0], "code": row[1].strip(), "title": row[2],
+             "prod_count": row[4] if active_only else row[3], "active_count": row[4]}
             for row in rows
         ]
 
@@ -353,6 +1113,814 @@ def get_categories():
         return jsonify({"error": str(e)}), 500
 
 
+# ==============================================================
+# --------------------------------------------------------------
+# 🔖 Курсор для keyset-пагінації /products
+#    Непрозорий для клієнта рядок: base64url від [lang, category_code, title, id] останнього рядка сторінки.
+
+def _encode_products_cursor(lang: str, category_code: str, title: str, product_id: int) -> str:
+    raw = json.dumps([lang, category_code, title, product_id], ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_products_cursor(cursor: str, lang: str) -> Optional[Tuple[str, str, int]]:
+    """
+    Возвращает (category_code, title, product_id) или None, если курсор битый
+    или выдан для другого языка (сортировка идёт по title_<lang>).
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cur_lang, category_code, title, product_id = json.loads(raw.decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        return None
+
+    if cur_lang != lang or not isinstance(category_code, str) or not isinstance(title, str) \
+            or not isinstance(product_id, int) or isinstance(product_id, bool):
+        return None
+    return category_code, title, product_id
+
+
+# ==============================================================
+# --------------------------------------------------------------
+# 🏷️ Версія каталогу
+#    Змінюється при будь-якій зміні products або price_list (updated_at + кількість рядків,
+#    щоб помітити і видалення). Потрібна migrations/004_catalog_updated_at.sql.
+
+_catalog_version_memo: Tuple[float, str] = (0.0, '')
+
+
+def _catalog_version() -> str:
+    """Перевіряється в БД не частіше ніж раз на CATALOG_VERSION_TTL сек."""
+    global _catalog_version_memo
+    if _catalog_engine is not None and _catalog_engine.version:
+        return _catalog_engine.version  # знімок у пам'яті сам стежить за змінами
+
+    checked_at, version = _catalog_version_memo
+    if version and time.monotonic() - checked_at < CATALOG_VERSION_TTL:
+        return version
+
+    try:
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT
+                    (SELECT max(updated_at) FROM public.products),
+                    (SELECT count(*)        FROM public.products),
+                    (SELECT max(updated_at) FROM public.price_list),
+                    (SELECT count(*)        FROM public.price_list)
+            """)
+            row = cur.fetchone()
+    except Exception as e:
+        # без версії кешем користуватись не можна — повертаємо щоразу нову
+        log.warning(f"Catalog version probe failed: {e}")
+        return f"unknown-{time.time()}"
+
+    version = hashlib.sha1(repr(row).encode('utf-8')).hexdigest()[:16]
+    _catalog_version_memo = (time.monotonic(), version)
+    return version
+
+
+# ==============================================================
+# --------------------------------------------------------------
+# 🗄️ LRU-кеш готових відповідей з лімітом за розміром у байтах
+
+class ByteBudgetLRU:
+    """
+    Значення — кортеж, останній елемент якого bytes (тіло відповіді);
+    при перевищенні max_bytes витісняються найдавніше використані записи.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple, entry: tuple):
+        size = len(entry[-1])
+        if size > self._max_bytes // 4:
+            return  # одна відповідь не повинна витісняти весь кеш
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[-1])
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted[-1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+# (catalog_version, stored_at, etag, body)
+_products_cache = ByteBudgetLRU(PRODUCTS_CACHE_MAX_BYTES)
+
+
+# ==============================================================
+# --------------------------------------------------------------
+# 📦 Рядок списку товарів (спільний для /products та /products/export)
+
+# Головне зображення товару (без варіанту) тим самим запитом, що й товар.
+# has_data перевіряє лише NULL-біт і не читає сам BYTEA.
+PRIMARY_IMAGE_LATERAL = """
+    LEFT JOIN LATERAL (
+        SELECT i.image_path, i.img_data IS NOT NULL AS has_data
+        FROM public.images i
+        WHERE i.product_code = p.code AND COALESCE(i.subprod_code, '') = ''
+        ORDER BY i.is_primary DESC, i.id
+        LIMIT 1
+    ) img ON TRUE
+"""
+
+
+def _primary_image_map(rows: List[dict]) -> ImagePathMap:
+    """
+    Карта (product_code, None) -> шлях з колонок image_path / image_pending (PRIMARY_IMAGE_LATERAL).
+    _fetch_image_paths_bulk викликається лише для тих, чиє зображення ще треба записати на диск.
+    """
+    image_map: ImagePathMap = _image_path_cache_get([(row['product_code'], None) for row in rows])
+    pending: List[ImageKey] = []
+    confirmed: ImagePathMap = {}
+    for row in rows:
+        key: ImageKey = (row['product_code'], None)
+        path = row['image_path']
+        if path and image_map.get(key) == path:
+            continue  # шлях уже перевірено — без os.path.exists
+        if path and path != NO_IMAGE_MARKER and os.path.exists(path):
+            image_map[key] = confirmed[key] = path
+        elif row['image_pending']:
+            pending.append(key)
+        else:
+            image_map[key] = ''
+
+    _image_path_cache_put(confirmed)
+    if pending:
+        if IMAGE_MATERIALIZE == "inline":
+            image_map.update(_fetch_image_paths_bulk(pending))
+        else:
+            image_map.update((key, '') for key in pending)  # файл запише ImageMaterializer
+            _image_materializer.wake()
+    return image_map
+
+
+def _product_list_item(row: dict, image_map: ImagePathMap, thumb_width: Optional[int] = None) -> dict:
+    item = {
+        'id'            : row['product_id'],
+        'category'      : row['category_name'] or '',
+        'title'         : row['product_title'] or '',
+        'description'   : row['product_descr'] or '',
+        'price'         : float(row['price']),
+        'quantity'      : int(row['quantity']),
+        'image'         : image_map.get((row['product_code'], None), ''),
+        'measure'       : '',
+        'is_variative'  : bool(row['is_variative'])
+    }
+    if thumb_width:
+        item['thumb'] = _thumb_url(item['image'], thumb_width)
+    return item
+
+
+# ==============================================================
+# --------------------------------------------------------------
+# 🧠 Каталог у пам'яті (CATALOG_ENGINE=memory)
+#    products × price_list × categories × шляхи зображень завантажуються при старті воркера
+#    у компактні колонки (array/list за номером слота). Фоновий потік кожні CATALOG_REFRESH_INTERVAL сек.
+#    дочитує лише змінене за products.updated_at / price_list.updated_at / images.updated_at і підміняє
+#    знімок цілком, тож запит завжди бачить узгоджений стан. БД при цьому потрібна лише для оновлень.
+#    Видалені рядки дельта не бачить: раз на CATALOG_RECONCILE_INTERVAL сек. звіряються кількості
+#    (розбіжність — повне перезавантаження) і перечитується повний список зображень.
+#    Порядок сортування для кожної пари (lang, category) рахується наперед.
+#    Увага: рядки тут порівнюються за кодами символів, а не за collation бази,
+#    тож курсори, видані в SQL-режимі, можуть трохи «з'їжджати» після перемикання.
+
+class CatalogSnapshot:
+
+    def __init__(self):
+        self.slot_by_id: Dict[int, int] = {}
+        self.slot_by_code: Dict[str, int] = {}
+        self.ids = array('q')
+        self.codes: List[str] = []
+        self.category_codes: List[Optional[str]] = []
+        self.category_ids: List[Optional[int]] = []
+        self.active = bytearray()
+        self.variative = bytearray()
+        self.updated_at: List[Optional[datetime]] = []
+        self.titles: Dict[str, List[Optional[str]]] = {lang: [] for lang in VALID_LANGS}
+        self.descrs: Dict[str, List[Optional[str]]] = {lang: [] for lang in VALID_LANGS}
+        self.prices = {cur: array('d') for cur in VALID_CURRENCIES}
+        self.quantities = {cur: array('q') for cur in VALID_CURRENCIES}
+        self.price_updated_at: Dict[str, List[Optional[datetime]]] = {cur: [] for cur in VALID_CURRENCIES}
+        self.price_keys: set = set()  # (product_code, currency) — для виявлення видалених рядків price_list
+        self.image_paths: ImagePathMap = {}
+        self.orders: Dict[Tuple[str, str], List[int]] = {}  # (lang, category або '') -> слоти активних товарів
+        self.products_watermark: Optional[datetime] = None
+        self.prices_watermark: Optional[datetime] = None
+        self.images_watermark: Optional[datetime] = None
+        self.generation = 0
+
+    def clone(self) -> "CatalogSnapshot":
+        """Копія колонок для copy-on-write оновлення (порядки сортування спільні, поки не змінені)."""
+        snap = CatalogSnapshot()
+        snap.slot_by_id = dict(self.slot_by_id)
+        snap.slot_by_code = dict(self.slot_by_code)
+        snap.ids = array('q', self.ids)
+        snap.codes = list(self.codes)
+        snap.category_codes = list(self.category_codes)
+        snap.category_ids = list(self.category_ids)
+        snap.active = bytearray(self.active)
+        snap.variative = bytearray(self.variative)
+        snap.updated_at = list(self.updated_at)
+        snap.titles = {lang: list(col) for lang, col in self.titles.items()}
+        snap.descrs = {lang: list(col) for lang, col in self.descrs.items()}
+        snap.prices = {cur: array('d', col) for cur, col in self.prices.items()}
+        snap.quantities = {cur: array('q', col) for cur, col in self.quantities.items()}
+        snap.price_updated_at = {cur: list(col) for cur, col in self.price_updated_at.items()}
+        snap.price_keys = set(self.price_keys)
+        snap.image_paths = self.image_paths
+        snap.orders = dict(self.orders)
+        snap.products_watermark = self.products_watermark
+        snap.prices_watermark = self.prices_watermark
+        snap.images_watermark = self.images_watermark
+        snap.generation = self.generation
+        return snap
+
+    def sort_key(self, lang: str, slot: int) -> Tuple[str, str, int]:
+        # той самий порядок, що й у SQL: COALESCE(p.category_code, ''), COALESCE(p.title_<lang>, ''), p.id
+        return self.category_codes[slot] or '', self.titles[lang][slot] or '', self.ids[slot]
+
+    # --- застосування рядків з БД; повертають набір категорій, порядок яких треба перерахувати ---
+
+    def apply_product(self, row: tuple) -> set:
+        product_id, code, category_code, category_id, is_active, is_variative, updated_at = row[:7]
+        # коди категорій можуть бути доповнені пробілами (CHAR); SQL-порівняння їх ігнорує,
+        # а ключі orders / фасетів — ні, тому нормалізуємо так само, як маршрути
+        category_code = category_code.rstrip() if category_code else category_code
+        texts = row[7:]
+        langs = sorted(VALID_LANGS)
+
+        slot = self.slot_by_id.get(product_id)
+        if slot is None:
+            slot = len(self.ids)
+            self.slot_by_id[product_id] = slot
+            self.ids.append(product_id)
+            self.codes.append(code)
+            self.category_codes.append(category_code)
+            self.category_ids.append(category_id)
+            self.active.append(1 if is_active else 0)
+            self.variative.append(1 if is_variative else 0)
+            self.updated_at.append(updated_at)
+            for i, lang in enumerate(langs):
+                self.titles[lang].append(texts[i])
+                self.descrs[lang].append(texts[len(langs) + i])
+            for cur in VALID_CURRENCIES:
+                self.prices[cur].append(0.0)
+                self.quantities[cur].append(0)
+                self.price_updated_at[cur].append(None)
+            self.slot_by_code[code] = slot
+            return {category_code or ''} if is_active else set()
+
+        if self.updated_at[slot] == updated_at and self.codes[slot] == code:
+            return set()  # рядок з перекриття вікна дельти, вже застосований
+
+        dirty = {self.category_codes[slot] or '', category_code or ''}
+        if self.codes[slot] != code:
+            self.slot_by_code.pop(self.codes[slot], None)
+            self.slot_by_code[code] = slot
+            for cur in VALID_CURRENCIES:  # ціни старого коду — не цього товару; нові дочитає CatalogEngine
+                self.prices[cur][slot] = 0.0
+                self.quantities[cur][slot] = 0
+                self.price_updated_at[cur][slot] = None
+        self.codes[slot] = code
+        self.category_codes[slot] = category_code
+        self.category_ids[slot] = category_id
+        self.active[slot] = 1 if is_active else 0
+        self.variative[slot] = 1 if is_variative else 0
+        self.updated_at[slot] = updated_at
+        for i, lang in enumerate(langs):
+            self.titles[lang][slot] = texts[i]
+            self.descrs[lang][slot] = texts[len(langs) + i]
+        return dirty
+
+    def apply_price(self, row: tuple) -> bool:
+        product_code, currency, price, quantity, updated_at = row
+        self.price_keys.add((product_code, currency))
+        slot = self.slot_by_code.get(product_code)
+        if slot is None or currency not in VALID_CURRENCIES:
+            return False
+        price, quantity = float(price or 0), int(quantity or 0)
+        if (self.prices[currency][slot], self.quantities[currency][slot]) == (price, quantity) \
+                and self.price_updated_at[currency][slot] == updated_at:
+            return False
+        self.prices[currency][slot] = price
+        self.quantities[currency][slot] = quantity
+        self.price_updated_at[currency][slot] = updated_at
+        return True
+
+    def rebuild_orders(self, categories: Optional[set] = None):
+        """Перераховує порядок для вказаних категорій (None — для всіх) і загальний порядок."""
+        if categories is None:
+            categories = {code or '' for code in self.category_codes}
+        categories = set(categories) | {''}
+
+        active_slots = [slot for slot in range(len(self.ids)) if self.active[slot]]
+        by_category: Dict[str, List[int]] = {}
+        for slot in active_slots:
+            code = self.category_codes[slot] or ''
+            if code in categories:
+                by_category.setdefault(code, []).append(slot)
+
+        for lang in VALID_LANGS:
+            for code in categories:
+                slots = active_slots if code == '' else by_category.get(code, [])
+                self.orders[(lang, code)] = sorted(slots, key=lambda s, lang=lang: self.sort_key(lang, s))
+
+    # --- читання ---
+
+    def list_row(self, slot: int, lang: str, currency: str) -> dict:
+        """Рядок у форматі SQL-запиту get_products (для _product_list_item)."""
+        return {
+            'product_id'    : self.ids[slot],
+            'category_name' : self.category_codes[slot],
+            'category_key'  : self.category_codes[slot] or '',
+            'product_title' : self.titles[lang][slot],
+            'product_descr' : self.descrs[lang][slot],
+            'price'         : self.prices[currency][slot],
+            'quantity'      : self.quantities[currency][slot],
+            'product_code'  : self.codes[slot],
+            'is_variative'  : self.variative[slot],
+        }
+
+    def detail_row(self, slot: int, lang: str, currency: str) -> dict:
+        """Рядок у форматі SQL-запиту get_product (для _product_detail)."""
+        return {
+            'id'            : self.ids[slot],
+            'product_code'  : self.codes[slot],
+            'category_id'   : self.category_ids[slot],
+            'category'      : self.category_codes[slot],
+            'is_active'     : bool(self.active[slot]),
+            'title'         : self.titles[lang][slot],
+            'description'   : self.descrs[lang][slot],
+            'updated_at'    : self.updated_at[slot],
+            'price'         : self.prices[currency][slot],
+            'quantity'      : self.quantities[currency][slot],
+        }
+
+    def validator(self, slot: int, subprod_code: Optional[str], lang: str,
+                  currency: str) -> Tuple[str, Optional[datetime]]:
+        """(etag, last_modified) для умовного GET /products/<product_str>."""
+        code = self.codes[slot]
+        product_updated = self.updated_at[slot]
+        price_updated = self.price_updated_at[currency][slot]
+        images = [self.image_paths.get(key, '') for key in _product_image_keys(code, subprod_code)]
+
+        stamps = [_as_utc(ts) for ts in (product_updated, price_updated) if ts is not None]
+        raw = repr((self.ids[slot], subprod_code, lang, currency, product_updated, price_updated, images))
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest(), max(stamps) if stamps else None
+
+    def matches(self, slot: int, currency: str, filters: "ProductFilters") -> bool:
+        price = self.prices[currency][slot]
+        if filters.min_price is not None and price < filters.min_price:
+            return False
+        if filters.max_price is not None and price > filters.max_price:
+            return False
+        if filters.in_stock is not None and (self.quantities[currency][slot] > 0) != filters.in_stock:
+            return False
+        if filters.is_variative is not None and bool(self.variative[slot]) != filters.is_variative:
+            return False
+        return True
+
+    def page(self, lang: str, category: str, start: int, limit: int,
+             after_key: Optional[Tuple[str, str, int]],
+             currency: str = DEFAULT_CURRENCY, filters: Optional["ProductFilters"] = None) -> List[int]:
+        """Слоти сторінки (до limit + 1, щоб знати про наступну)."""
+        order = self.orders.get((lang, category), [])
+        skip = start
+        start = 0
+        if after_key:
+            start = bisect.bisect_right(order, tuple(after_key), key=lambda s: self.sort_key(lang, s))
+            skip = 0
+
+        if not filters:
+            return order[start + skip:start + skip + limit + 1]
+
+        result = []
+        for slot in itertools.islice(order, start, None):
+            if self.matches(slot, currency, filters):
+                if skip:
+                    skip -= 1
+                    continue
+                result.append(slot)
+                if len(result) > limit:
+                    break
+        return result
+
+    def facets(self, category: str, currency: str, filters: "ProductFilters") -> dict:
+        """Фасети за один прохід (та сама семантика, що й _query_product_facets)."""
+        by_category: Dict[str, int] = {}
+        by_bucket: Dict[int, int] = {}
+        for slot in self.orders.get((DEFAULT_LANG, ''), []):
+            if not self.matches(slot, currency, filters):
+                continue
+            code = self.category_codes[slot] or ''
+            by_category[code] = by_category.get(code, 0) + 1
+            if not category or code == category:
+                bucket = bisect.bisect_right(PRICE_FACET_BOUNDS, self.prices[currency][slot])
+                by_bucket[bucket] = by_bucket.get(bucket, 0) + 1
+        return _format_facets(by_category, by_bucket)
+
+
+class CatalogEngine:
+
+    def __init__(self):
+        self.snapshot: Optional[CatalogSnapshot] = None
+        self._lock = threading.Lock()
+        self._reconciled_at = 0.0
+
+    @property
+    def version(self) -> Optional[str]:
+        snap = self.snapshot
+        return f"mem-{snap.generation}" if snap is not None else None
+
+    def _products_sql(self, delta: bool) -> str:
+        langs = sorted(VALID_LANGS)
+        texts = ', '.join([f"p.title_{lang}" for lang in langs] + [f"p.descr_{lang}" for lang in langs])
+        sql = f"""
+            SELECT p.id, p.code, c.code, c.id, p.is_active, p.is_variative, p.updated_at, {texts}
+            FROM products p
+            LEFT JOIN categories c ON p.category_code = c.code
+        """
+        if delta:
+            sql += " WHERE p.updated_at > %s"
+        return sql
+
+    _PRICES_SQL = """
+        SELECT product_code, lower(currency_code), price, stock_quantity, updated_at
+        FROM public.price_list
+        WHERE COALESCE(subprod_code, '') = '' AND lower(currency_code) = ANY(%s)
+    """
+
+    def load(self):
+        """Повне завантаження."""
+        started = time.monotonic()
+        snap = CatalogSnapshot()
+        with db_connection(shared=False) as conn, conn.cursor() as cur:
+            cur.execute(self._products_sql(delta=False))
+            for row in cur:
+                snap.apply_product(row)
+                snap.products_watermark = _max_ts(snap.products_watermark, row[6])
+
+            cur.execute(self._PRICES_SQL, (list(VALID_CURRENCIES),))
+            for row in cur:
+                snap.apply_price(row)
+                snap.prices_watermark = _max_ts(snap.prices_watermark, row[4])
+
+        snap.image_paths, snap.images_watermark = self._load_image_paths(snap)
+        snap.rebuild_orders()
+        snap.generation = (self.snapshot.generation + 1) if self.snapshot else 1
+        self.snapshot = snap
+        self._reconciled_at = time.monotonic()
+        log.info(f"Catalog engine loaded: {len(snap.ids)} products, {len(snap.price_keys)} prices, "
+                 f"{len(snap.image_paths)} images in {time.monotonic() - started:.2f}s")
+
+    def refresh(self):
+        """
+        Інкрементальне оновлення. Раз на CATALOG_RECONCILE_INTERVAL — звірка кількостей
+        (якщо рядки видаляли — повне перезавантаження) і повний список зображень.
+        """
+        with self._lock:
+            old = self.snapshot
+            if old is None:
+                self.load()
+                return
+
+            snap = None
+            dirty_categories = set()
+            prices_changed = False
+            reconcile = time.monotonic() - self._reconciled_at >= CATALOG_RECONCILE_INTERVAL
+
+            with db_connection(shared=False) as conn, conn.cursor() as cur:
+                cur.execute(self._products_sql(delta=True),
+                            (old.products_watermark - CATALOG_REFRESH_OVERLAP if old.products_watermark else datetime.min,))
+                rows = cur.fetchall()
+                recoded = []  # коди нових / перейменованих товарів: їхні ціни можуть бути старшими за вікно дельти
+                if rows:
+                    snap = old.clone()
+                    for row in rows:
+                        slot = snap.slot_by_id.get(row[0])
+                        if slot is None or snap.codes[slot] != row[1]:
+                            recoded.append(row[1])
+                        dirty_categories |= snap.apply_product(row)
+                        snap.products_watermark = _max_ts(snap.products_watermark, row[6])
+
+                if recoded:
+                    cur.execute(self._PRICES_SQL + " AND product_code = ANY(%s)", (list(VALID_CURRENCIES), recoded))
+                    for row in cur.fetchall():
+                        prices_changed |= snap.apply_price(row)
+
+                cur.execute(self._PRICES_SQL + " AND updated_at > %s",
+                            (list(VALID_CURRENCIES),
+                             old.prices_watermark - CATALOG_REFRESH_OVERLAP if old.prices_watermark else datetime.min))
+                rows = cur.fetchall()
+                if rows:
+                    snap = snap or old.clone()
+                    for row in rows:
+                        prices_changed |= snap.apply_price(row)
+                        snap.prices_watermark = _max_ts(snap.prices_watermark, row[4])
+
+                if reconcile:
+                    # Дельта за updated_at не бачить видалених рядків — звіряємо кількість
+                    cur.execute("""
+                        SELECT
+                            (SELECT count(*) FROM public.products),
+                            (SELECT count(DISTINCT (product_code, lower(currency_code))) FROM public.price_list
+                              WHERE COALESCE(subprod_code, '') = '' AND lower(currency_code) = ANY(%s))
+                    """, (list(VALID_CURRENCIES),))
+                    products_count, prices_count = cur.fetchone()
+
+                    current = snap or old
+                    if products_count != len(current.ids) or prices_count != len(current.price_keys):
+                        self.load()
+                        return
+
+            current = snap or old
+            if reconcile:
+                image_paths, images_watermark = self._load_image_paths(current)
+                self._reconciled_at = time.monotonic()
+            else:
+                image_paths, images_watermark = self._load_image_paths(current, since=old.images_watermark)
+            images_changed = image_paths != old.image_paths
+
+            if not (dirty_categories or prices_changed or images_changed):
+                return
+
+            snap = snap or old.clone()
+            snap.image_paths = image_paths
+            snap.images_watermark = images_watermark
+            if dirty_categories:
+                snap.rebuild_orders(dirty_categories)
+            snap.generation = old.generation + 1
+            self.snapshot = snap
+            log.debug(f"Catalog engine refreshed: categories={sorted(dirty_categories)}, "
+                      f"prices={prices_changed}, images={images_changed}")
+
+    _IMAGES_SQL = """
+        SELECT DISTINCT ON (product_code, COALESCE(subprod_code, ''))
+            product_code, subprod_code, image_path, updated_at
+        FROM public.images
+        ORDER BY product_code, COALESCE(subprod_code, ''), is_primary DESC, id
+    """
+
+    # головне зображення лише для ключів, де з часу мітки щось змінилося (вставка, новий шлях, is_primary)
+    _IMAGES_DELTA_SQL = """
+        WITH changed AS (
+            SELECT product_code, COALESCE(subprod_code, '') AS sub, max(updated_at) AS updated_at
+            FROM public.images
+            WHERE updated_at > %s
+            GROUP BY 1, 2
+        )
+        SELECT DISTINCT ON (i.product_code, COALESCE(i.subprod_code, ''))
+            i.product_code, i.subprod_code, i.image_path, ch.updated_at
+        FROM changed ch
+        JOIN public.images i ON i.product_code = ch.product_code AND COALESCE(i.subprod_code, '') = ch.sub
+        ORDER BY i.product_code, COALESCE(i.subprod_code, ''), i.is_primary DESC, i.id
+    """
+
+    def _load_image_paths(self, snap: CatalogSnapshot,
+                          since: Optional[datetime] = None) -> Tuple[ImagePathMap, Optional[datetime]]:
+        """
+        Шляхи головних зображень без BYTEA: усі, або (since) — snap.image_paths плюс змінені після since.
+        Ключі, де шлях ще не записаний, віддаються ImageMaterializer
+        (або в _fetch_image_paths_bulk при IMAGE_MATERIALIZE=inline).
+        """
+        paths: ImagePathMap = dict(snap.image_paths) if since is not None else {}
+        watermark = since
+        pending: List[ImageKey] = []
+        with db_connection(shared=False) as conn, conn.cursor() as cur:
+            if since is not None:
+                cur.execute(self._IMAGES_DELTA_SQL, (since - CATALOG_REFRESH_OVERLAP,))
+            else:
+                cur.execute(self._IMAGES_SQL)
+            for code, sub, path, updated_at in cur:
+                key: ImageKey = (code, sub if sub else None)
+                watermark = _max_ts(watermark, updated_at)
+                if path and path != NO_IMAGE_MARKER:
+                    paths[key] = path
+                    continue
+                paths.pop(key, None)
+                if not path and code in snap.slot_by_code and snap.active[snap.slot_by_code[code]]:
+                    pending.append(key)
+
+        if IMAGE_MATERIALIZE != "inline":
+            if pending:
+                _image_materializer.wake()  # шляхи з'являться в одному з наступних refresh
+            return paths, watermark
+
+        for i in range(0, len(pending), MAX_PAGE_LIMIT):
+            for key, path in _fetch_image_paths_bulk(pending[i:i + MAX_PAGE_LIMIT]).items():
+                if path:
+                    paths[key] = path
+        return paths, watermark
+
+    def run(self):
+        """Тіло фонового потоку."""
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error(f"Catalog engine refresh failed: {e}", exc_info=True)
+            time.sleep(CATALOG_REFRESH_INTERVAL)
+
+
+def _max_ts(a: Optional[datetime], b: Optional[datetime]) -> Optional[datetime]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+_catalog_engine: Optional[CatalogEngine] = CatalogEngine() if CATALOG_ENGINE == "memory" else None
+
+
+def _catalog_snapshot() -> Optional[CatalogSnapshot]:
+    """Поточний знімок або None, якщо рушій вимкнено чи ще не завантажився."""
+    return _catalog_engine.snapshot if _catalog_engine is not None else None
+
+
+# ==============================================================
+# --------------------------------------------------------------
+# 🎚️ Фільтри (min_price, max_price, in_stock, is_variative) та фасети для /products
+#    Індекси: migrations/006_product_filters.sql
+
+class ProductFilters(NamedTuple):
+    min_price       : Optional[float] = None
+    max_price       : Optional[float] = None
+    in_stock        : Optional[bool] = None
+    is_variative    : Optional[bool] = None
+
+    def __bool__(self) -> bool:
+        return any(value is not None for value in self)
+
+
+def _parse_product_filters(args) -> ProductFilters:
+    """ValueError, якщо ціна не число."""
+    min_price = args.get('min_price', '').strip()
+    max_price = args.get('max_price', '').strip()
+    return ProductFilters(
+        min_price       = float(min_price) if min_price else None,
+        max_price       = float(max_price) if max_price else None,
+        in_stock        = _parse_bool_arg(args.get('in_stock')),
+        is_variative    = _parse_bool_arg(args.get('is_variative')),
+    )
+
+
+def _product_filters_sql(filters: ProductFilters) -> Tuple[str, list]:
+    """Умови WHERE для запиту з аліасами p (products) та pl (price_list)."""
+    # Відсутня ціна/залишок рахується як 0. Коли умова й так відкидає 0 (а з ним і NULL) —
+    # пишемо колонку без COALESCE, щоб планувальник міг узяти індекси migrations/006.
+    sql, params = "", []
+    if filters.min_price is not None:
+        sql += " AND pl.price >= %s" if filters.min_price > 0 else " AND COALESCE(pl.price, 0) >= %s"
+        params.append(filters.min_price)
+    if filters.max_price is not None:
+        sql += " AND pl.price <= %s" if filters.max_price < 0 else " AND COALESCE(pl.price, 0) <= %s"
+        params.append(filters.max_price)
+    if filters.in_stock is not None:
+        sql += " AND pl.stock_quantity > 0" if filters.in_stock else " AND COALESCE(pl.stock_quantity, 0) <= 0"
+    if filters.is_variative is not None:
+        sql += " AND p.is_variative = %s"
+        params.append(filters.is_variative)
+    return sql, params
+
+
+def _format_facets(by_category: Dict[str, int], by_bucket: Dict[int, int]) -> dict:
+    """bucket — номер діапазону як у width_bucket: 0 — нижче першої межі, i — [bounds[i-1], bounds[i])"""
+    bounds = PRICE_FACET_BOUNDS
+    price = []
+    for bucket in sorted(by_bucket):
+        price.append({
+            "min"   : bounds[bucket - 1] if bucket > 0 else None,
+            "max"   : bounds[bucket] if bucket < len(bounds) else None,
+            "count" : by_bucket[bucket]
+        })
+    return {
+        "categories": [{"code": code, "count": by_category[code]} for code in sorted(by_category)],
+        "price"     : price
+    }
+
+
+def _query_product_facets(currency: str, category: str, filters: ProductFilters) -> dict:
+    """
+    Один агрегатний прохід (GROUPING SETS) замість запиту на кожен фасет.
+    Лічильники категорій ігнорують фільтр category (щоб бачити сусідні категорії),
+    цінові діапазони — враховують його.
+    """
+    filters_sql, filters_params = _product_filters_sql(filters)
+    sql = f"""
+        WITH filtered AS (
+            SELECT
+                rtrim(COALESCE(c.code, '')) AS category,
+                width_bucket(COALESCE(pl.price, 0), %s::numeric[]) AS bucket
+            FROM products p
+            LEFT JOIN categories c ON p.category_code = c.code
+            LEFT JOIN price_list pl ON p.code = pl.product_code AND pl.currency_code = %s
+                                   AND COALESCE(pl.subprod_code, '') = ''
+            WHERE p.is_active = TRUE {filters_sql}
+        )
+        SELECT
+            GROUPING(category) AS by_bucket,
+            category,
+            bucket,
+            COUNT(*) AS total,
+            COUNT(*) FILTER (WHERE %s = '' OR category = %s) AS in_category
+        FROM filtered
+        GROUP BY GROUPING SETS ((category), (bucket))
+    """
+    params = [PRICE_FACET_BOUNDS, currency, *filters_params, category, category]
+
+    by_category: Dict[str, int] = {}
+    by_bucket: Dict[int, int] = {}
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute(sql, params)
+        for by_bucket_row, code, bucket, total, in_category in cur.fetchall():
+            if by_bucket_row:
+                if in_category:
+                    by_bucket[bucket] = in_category
+            else:
+                by_category[code] = total
+    return _format_facets(by_category, by_bucket)
+
+
+# ==============================================================
+# --------------------------------------------------------------
+# 📦 Сторінка товарів з БД (до limit + 1 рядків, щоб знати про наступну сторінку)
+
+def _query_products_rows(lang: str, currency: str, category: str, start: int, limit: int,
+                         after_key: Optional[Tuple[str, str, int]],
+                         filters: Optional["ProductFilters"] = None) -> List[dict]:
+    col_title = f"title_{lang}"
+    col_descr = f"descr_{lang}"
+
+    with db_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:  # возвращает dict
+
+        # -- важно: только активные в запросе
+        base_sql = f"""
+            SELECT 
+                p.id AS product_id,
+                c.code AS category_name,
+                rtrim(COALESCE(p.category_code, '')) AS category_key,  -- без CHAR-доповнення, як у знімку
+                p.{col_title} AS product_title,
+                p.{col_descr} AS product_descr,
+                COALESCE(pl.price, 0) AS price,
+                COALESCE(pl.stock_quantity, 0) AS quantity,
+                p.code AS product_code,
+                p.is_variative,
+                img.image_path,
+                COALESCE(img.has_data, FALSE) AS image_pending
+            FROM products p
+            LEFT JOIN categories c ON p.category_code = c.code
+            LEFT JOIN price_list pl ON p.code = pl.product_code AND pl.currency_code = %s
+                                   AND COALESCE(pl.subprod_code, '') = ''  -- базова ціна, один рядок на товар
+            {PRIMARY_IMAGE_LATERAL}
+            WHERE p.is_active = TRUE  
+        """
+        params = [currency]
+
+        if category:
+            base_sql += " AND COALESCE(p.category_code, '') = %s"
+            params.append(category)
+
+        if filters:
+            filters_sql, filters_params = _product_filters_sql(filters)
+            base_sql += filters_sql
+            params.extend(filters_params)
+
+        # Порядок однаковий для обох режимів; p.id робить його однозначним.
+        # Лише колонки products — збігається з індексами migrations/009_products_keyset.sql,
+        # тож сторінка читається з індексу без join і сортування всіх активних товарів
+        sort_key = f"COALESCE(p.category_code, ''), COALESCE(p.{col_title}, ''), p.id"
+        if after_key:
+            base_sql += f" AND ({sort_key}) > (%s, %s, %s)"
+            params.extend(after_key)
+
+        base_sql += f" ORDER BY {sort_key} LIMIT %s OFFSET %s"
+        params.extend([limit + 1, start])
+
+        cur.execute(base_sql, params)
+        return cur.fetchall()
+
+
 # ==============================================================
 # --------------------------------------------------------------
 # 📦 Отримати список товарів [GET]
@@ -387,90 +1955,464 @@ def get_products():
     req_lang = request.args.get('lang', DEFAULT_LANG).lower()
     if req_lang not in VALID_LANGS:
         req_lang = DEFAULT_LANG
+
+    # ids=1,2,3|VAR — картки кількох товарів одним запитом замість N викликів /products/<product_str>
+    req_ids = request.args.get('ids', '').strip()
+    if req_ids:
+        return _get_products_by_ids(req_ids, req_lang, req_currency)
     
-    col_title = f"title_{req_lang}"
-    col_descr = f"descr_{req_lang}"
+    try:
+        req_filters = _parse_product_filters(request.args)
+    except ValueError:
+        return jsonify({"error": "Invalid min_price or max_price"}), 400
+    req_facets = _parse_bool_arg(request.args.get('facets')) or False
 
-    log.debug(f"Params: start={req_start}, limit={req_limit}, category={req_category}, currency={req_currency}, lang={req_lang}")
+    # thumb=200 — додати до кожного товару URL мініатюри (ширина з THUMB_WIDTHS)
+    req_thumb = None
+    if request.args.get('thumb'):
+        req_thumb = _parse_thumb_width(request.args.get('thumb'))
+        if req_thumb is None:
+            return jsonify({"error": f"Invalid thumb width (allowed: {THUMB_WIDTHS})"}), 400
 
+    # cursor має пріоритет над start: сторінка береться після останнього переданого рядка
+    req_cursor = request.args.get('cursor', '').strip()
+    after_key = None
+    if req_cursor:
+        after_key = _decode_products_cursor(req_cursor, req_lang)
+        if after_key is None:
+            return jsonify({"error": "Invalid cursor"}), 400
+        req_start = 0
 
+    log.debug(f"Params: start={req_start}, limit={req_limit}, category={req_category}, currency={req_currency}, lang={req_lang}, cursor={after_key}")
 
-    conn = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)  # возвращает dict
 
-        # -- важно: только активные в запросе
-        base_sql = f"""
-            SELECT 
-                p.id AS product_id,
-                c.code AS category_name,
-                p.{col_title} AS product_title,
-                p.{col_descr} AS product_descr,
-                COALESCE(pl.price, 0) AS price,
-                COALESCE(pl.stock_quantity, 0) AS quantity,
-                p.code AS product_code,
-                p.is_variative
-            FROM products p
-            LEFT JOIN categories c ON p.category_code = c.code
-            LEFT JOIN price_list pl ON p.code = pl.product_code AND pl.currency_code = %s
-            WHERE p.is_active = TRUE  
-        """
-        params = [req_currency]
 
-        if req_category:
-            base_sql += " AND c.code = %s"
-            params.append(req_category)
-
-        base_sql += f" ORDER BY c.code, p.{col_title} LIMIT %s OFFSET %s"
-        params.extend([req_limit, req_start])
+    try:
+        # === Кеш готових відповідей ===
+        cache_key = (req_lang, req_currency, req_category, req_start, req_limit, after_key, req_filters, req_facets,
+                     req_thumb)
+        catalog_version = _catalog_version()
+        cached = _products_cache.get(cache_key)
+        if cached and cached[0] == catalog_version and time.time() - cached[1] < PRODUCTS_CACHE_TTL:
+            log.debug("    Served from response cache")
+            return _json_bytes_response(cached[3], cached[2], PRODUCTS_CACHE_CONTROL)
+
+        snap = _catalog_snapshot()
+        if snap is not None:
+            # === Каталог у пам'яті: фільтр, сортування й сторінка без звернення до БД ===
+            rows = [snap.list_row(slot, req_lang, req_currency)
+                    for slot in snap.page(req_lang, req_category, req_start, req_limit, after_key,
+                                          req_currency, req_filters)]
+        else:
+            rows = _query_products_rows(req_lang, req_currency, req_category, req_start, req_limit, after_key,
+                                        req_filters)
 
-        
-        cur.execute(base_sql, params)
-        rows = cur.fetchall()
+        has_more = len(rows) > req_limit
+        rows = rows[:req_limit]
         total_fetched = len(rows)
 
-        log.debug(f"    Fetched {total_fetched} products from DB")
+        log.debug(f"    Fetched {total_fetched} products from {'memory' if snap is not None else 'DB'}")
 
 
         # === Получение изображений одним запросом ===
-        items = [(row['product_code'], None) for row in rows]  # subprod_code = None
-        image_map = _fetch_image_paths_bulk(items)
-        
+        if snap is not None:
+            image_map = snap.image_paths
+        else:
+            image_map = _primary_image_map(rows)  # шляхи прийшли разом з товарами
+
 
        # === Формирование ответа ===
-        products = []
-        for row in rows:
-            code = row['product_code']
-            products.append({
-                'id'            : row['product_id'],
-                'category'      : row['category_name'] or '',
-                'title'         : row['product_title'] or '',
-                'description'   : row['product_descr'] or '',
-                'price'         : float(row['price']),
-                'quantity'      : int(row['quantity']),
-                'image'         : image_map.get((code, None), ''),
-                'measure'       : '',
-                'is_variative'  : bool(row['is_variative'])
-            })
+        products = [_product_list_item(row, image_map, req_thumb) for row in rows]
+        if req_thumb:
+            _schedule_thumbnails([item['image'] for item in products], req_thumb)  # готуємо наперед, не чекаючи
+
+        next_cursor = None
+        if has_more:
+            last = rows[-1]
+            next_cursor = _encode_products_cursor(
+                req_lang, last['category_key'], last['product_title'] or '', last['product_id'])
+
+        response = {
+            "currency"      : req_currency,
+            "count"         : total_fetched,
+            "start"         : req_start,
+            "limit"         : req_limit,
+            "next_cursor"   : next_cursor,
+            "products"      : products
+        }
+
+        if req_facets:
+            if snap is not None:
+                response["facets"] = snap.facets(req_category, req_currency, req_filters)
+            else:
+                response["facets"] = _query_product_facets(req_currency, req_category, req_filters)
+
+        body, etag = _serialize_json(response)
+        _products_cache.put(cache_key, (catalog_version, time.time(), etag, body))
+        return _json_bytes_response(body, etag, PRODUCTS_CACHE_CONTROL)
+
+    except Exception as e:
+        log.error(f"Error in get_products: {e}", exc_info=True)
+        return jsonify({"error": "Internal server error"}), 500
+    
+
+
+
+# ==============================================================
+# --------------------------------------------------------------
+# 📤 Потоковий експорт каталогу [GET] (NDJSON: один товар — один рядок)
+#    Для синхронізації ERP та офлайн-режиму мобільного клієнта.
+#    Рядки читаються серверним (named) курсором порціями по itersize,
+#    зображення резолвляться для кожної порції окремо — пам'ять не росте з розміром каталогу.
+@app.route('/products/export', methods=['GET'])
+@require_auth
+def export_products():
+
+    log.debug(f"+++/products/export: user: {request.user_id}")
+
+    try:
+        itersize = min(EXPORT_MAX_ITERSIZE, max(1, int(request.args.get('itersize', EXPORT_ITERSIZE))))
+    except ValueError:
+        return jsonify({"error": "Invalid itersize"}), 400
+
+    req_category = request.args.get('category', '').strip().lower()
+    if len(req_category) > 50:
+        return jsonify({"error": "Category too long"}), 400
+
+    req_currency = request.args.get('currency', DEFAULT_CURRENCY).lower()
+    if req_currency not in VALID_CURRENCIES:
+        req_currency = DEFAULT_CURRENCY
+
+    req_lang = request.args.get('lang', DEFAULT_LANG).lower()
+    if req_lang not in VALID_LANGS:
+        req_lang = DEFAULT_LANG
+
+    col_title = f"title_{req_lang}"
+    col_descr = f"descr_{req_lang}"
+
+    sql = f"""
+        SELECT 
+            p.id AS product_id,
+            c.code AS category_name,
+            p.{col_title} AS product_title,
+            p.{col_descr} AS product_descr,
+            COALESCE(pl.price, 0) AS price,
+            COALESCE(pl.stock_quantity, 0) AS quantity,
+            p.code AS product_code,
+            p.is_variative
+        FROM products p
+        LEFT JOIN categories c ON p.category_code = c.code
+        LEFT JOIN price_list pl ON p.code = pl.product_code AND pl.currency_code = %s
+                               AND COALESCE(pl.subprod_code, '') = ''  -- один рядок на товар
+        WHERE p.is_active = TRUE
+    """
+    params = [req_currency]
+    if req_category:
+        sql += " AND COALESCE(p.category_code, '') = %s"
+        params.append(req_category)
+    sql += f" ORDER BY COALESCE(p.category_code, ''), COALESCE(p.{col_title}, ''), p.id"
+
+    def generate():
+        exported = 0
+        try:
+            # Окреме з'єднання: серверний курсор живе в транзакції, а хелпери зображень комітять свої зміни
+            with db_connection(shared=False) as conn:
+                with conn.cursor(name=f"catalog_export_{secrets.token_hex(4)}", cursor_factory=RealDictCursor) as cur:
+                    cur.itersize = itersize
+                    cur.execute(sql, params)
+
+                    while True:
+                        rows = cur.fetchmany(itersize)
+                        if not rows:
+                            break
+
+                        image_map = _fetch_image_paths_bulk([(row['product_code'], None) for row in rows])
+                        yield ''.join(app.json.dumps(_product_list_item(row, image_map)) + '\n' for row in rows)
+                        exported += len(rows)
+
+            log.debug(f"    Exported {exported} products (lang={req_lang}, currency={req_currency})")
+
+        except Exception as e:
+            # Статус уже відправлено — лише обриваємо потік
+            log.error(f"Error in export_products after {exported} rows: {e}", exc_info=True)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={"X-Accel-Buffering": "no"}
+    )
+
+
+
+# ==============================================================
+# --------------------------------------------------------------
+# 🔍 Повнотекстовий пошук товарів [GET]
+#    Ранжування за title_<lang> (вага A) та descr_<lang> (вага B), кожне слово — як префікс.
+#    Індекси: migrations/005_product_search.sql (GIN по tsvector + trigram по назві).
+#    Конфігурація 'simple': для ua/pl немає стемерів, а префікси покривають словоформи.
+
+def _search_tsquery(q: str) -> Optional[str]:
+    """'профіль 45' -> 'профіль:* & 45:*' (лише букви/цифри, тож синтаксис tsquery не зламати)"""
+    terms = re.findall(r'\w+', q.lower())[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    return ' & '.join(f"{term}:*" for term in terms)
+
+
+def _like_escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+@app.route('/products/search', methods=['GET'])
+@require_auth
+def search_products():
+
+    log.debug(f"+++/products/search: user: {request.user_id}")
+
+    req_query = request.args.get('q', '').strip()
+    if len(req_query) < SEARCH_MIN_LENGTH:
+        return jsonify({"error": f"Query too short (min {SEARCH_MIN_LENGTH} characters)"}), 400
+    if len(req_query) > 200:
+        return jsonify({"error": "Query too long"}), 400
+
+    tsquery = _search_tsquery(req_query)
+    if tsquery is None:
+        return jsonify({"error": "Query has no searchable words"}), 400
+
+    try:
+        req_start = max(0, int(request.args.get('start', 0)))
+        req_limit = min(MAX_PAGE_LIMIT, max(1, int(request.args.get('limit', DEFAULT_PAGE_LIMIT))))
+    except ValueError:
+        return jsonify({"error": "Invalid start or limit"}), 400
+
+    req_currency = request.args.get('currency', DEFAULT_CURRENCY).lower()
+    if req_currency not in VALID_CURRENCIES:
+        req_currency = DEFAULT_CURRENCY
+
+    req_lang = request.args.get('lang', DEFAULT_LANG).lower()
+    if req_lang not in VALID_LANGS:
+        req_lang = DEFAULT_LANG
+
+    col_title = f"title_{req_lang}"
+    col_descr = f"descr_{req_lang}"
+
+    # Вираз має збігатися з індексом products_search_<lang>_idx
+    document = (f"setweight(to_tsvector('simple', COALESCE(p.{col_title}, '')), 'A') || "
+                f"setweight(to_tsvector('simple', COALESCE(p.{col_descr}, '')), 'B')")
+
+    try:
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"""
+                    SELECT 
+                        p.id AS product_id,
+                        c.code AS category_name,
+                        p.{col_title} AS product_title,
+                        p.{col_descr} AS product_descr,
+                        COALESCE(pl.price, 0) AS price,
+                        COALESCE(pl.stock_quantity, 0) AS quantity,
+                        p.code AS product_code,
+                        p.is_variative,
+                        ts_rank({document}, q.query) AS rank
+                    FROM products p
+                    CROSS JOIN to_tsquery('simple', %s) AS q(query)
+                    LEFT JOIN categories c ON p.category_code = c.code
+                    LEFT JOIN price_list pl ON p.code = pl.product_code AND pl.currency_code = %s
+                                           AND COALESCE(pl.subprod_code, '') = ''  -- один рядок на товар
+                    WHERE p.is_active = TRUE
+                      AND ({document} @@ q.query OR p.{col_title} ILIKE %s OR p.code ILIKE %s)
+                    ORDER BY rank DESC, COALESCE(p.{col_title}, ''), p.id
+                    LIMIT %s OFFSET %s
+                """, (tsquery, req_currency, f"%{_like_escape(req_query)}%", f"{_like_escape(req_query)}%",
+                      req_limit, req_start))
+                rows = cur.fetchall()
+
+            # === Зображення одним запросом ===
+            image_map = _fetch_image_paths_bulk([(row['product_code'], None) for row in rows])
 
         response = {
+            "query"     : req_query,
             "currency"  : req_currency,
-            "count"     : total_fetched,
+            "count"     : len(rows),
             "start"     : req_start,
             "limit"     : req_limit,
-            "products"  : products
+            "products"  : [_product_list_item(row, image_map) for row in rows]
         }
+        return jsonify(response), 200
+
+    except Exception as e:
+        log.error(f"Error in search_products: {e}", exc_info=True)
+        return jsonify({"error": "Internal server error"}), 500
+
+
+
+# ==============================================================
+# --------------------------------------------------------------
+# ⌨️ Автодоповнення назв товарів [GET]
+#    Індекс у пам'яті воркера: для кожної мови — відсортований список (term, kind, product_id),
+#    де term — назва цілком, кожне її слово з середини (kind=1) та код товару.
+#    Пошук префікса — bisect, тож жодного запиту до БД на натискання клавіші.
+#    Будується при старті воркера й оновлюється за products.updated_at.
+
+class SuggestIndex:
+
+    def __init__(self):
+        self._entries: Dict[str, List[Tuple[str, int, int]]] = {lang: [] for lang in VALID_LANGS}
+        self._terms_by_product: Dict[int, List[Tuple[str, Tuple[str, int, int]]]] = {}
+        self._products: Dict[int, Tuple[str, Dict[str, str]]] = {}  # id -> (code, {lang: title})
+        self._watermark: Optional[datetime] = None
+        self._lock = threading.Lock()
+        self.ready = False
+
+    @staticmethod
+    def _terms(code: str, title: Optional[str]) -> List[Tuple[str, int]]:
+        terms = [(code.casefold(), 0)]
+        if title:
+            normalized = title.strip().casefold()
+            terms.append((normalized, 0))
+            for match in list(re.finditer(r'\w+', normalized))[1:]:
+                terms.append((normalized[match.start():], 1))
+        return terms
+
+    def _remove(self, product_id: int):
+        for lang, entry in self._terms_by_product.pop(product_id, []):
+            entries = self._entries[lang]
+            i = bisect.bisect_left(entries, entry)
+            if i < len(entries) and entries[i] == entry:
+                del entries[i]
+        self._products.pop(product_id, None)
+
+    def _add(self, product_id: int, code: str, titles: Dict[str, Optional[str]]):
+        added = []
+        for lang in VALID_LANGS:
+            for term, kind in self._terms(code, titles.get(lang)):
+                entry = (term, kind, product_id)
+                bisect.insort(self._entries[lang], entry)
+                added.append((lang, entry))
+        self._terms_by_product[product_id] = added
+        self._products[product_id] = (code, {lang: title or '' for lang, title in titles.items()})
+
+    def _fetch(self, cur, since: Optional[datetime]):
+        langs = sorted(VALID_LANGS)
+        sql = f"SELECT id, code, is_active, updated_at, {', '.join('title_' + lang for lang in langs)} FROM products"
+        if since is not None:
+            cur.execute(sql + " WHERE updated_at > %s", (since - CATALOG_REFRESH_OVERLAP,))
+        else:
+            cur.execute(sql)
+        for row in cur:
+            yield row[0], row[1], row[2], row[3], dict(zip(langs, row[4:]))
+
+    def load(self):
+        entries: Dict[str, List[Tuple[str, int, int]]] = {lang: [] for lang in VALID_LANGS}
+        terms_by_product, products, watermark = {}, {}, None
+
+        with db_connection(shared=False) as conn, conn.cursor() as cur:
+            for product_id, code, is_active, updated_at, titles in self._fetch(cur, None):
+                watermark = _max_ts(watermark, updated_at)
+                if not is_active:
+                    continue
+                added = []
+                for lang in VALID_LANGS:
+                    for term, kind in self._terms(code, titles.get(lang)):
+                        entries[lang].append((term, kind, product_id))
+                        added.append((lang, (term, kind, product_id)))
+                terms_by_product[product_id] = added
+                products[product_id] = (code, {lang: title or '' for lang, title in titles.items()})
+
+        for lang_entries in entries.values():
+            lang_entries.sort()
+
+        with self._lock:
+            self._entries, self._terms_by_product, self._products = entries, terms_by_product, products
+            self._watermark = watermark
+            self.ready = True
+        log.info(f"Suggest index built: {len(products)} products")
+
+    def refresh(self):
+        if not self.ready:
+            self.load()
+            return
+
+        with db_connection(shared=False) as conn, conn.cursor() as cur:
+            changed = list(self._fetch(cur, self._watermark))
+            cur.execute("SELECT count(*) FROM products WHERE is_active = TRUE")
+            active_count = cur.fetchone()[0]
+
+        with self._lock:
+            for product_id, code, is_active, updated_at, titles in changed:
+                self._watermark = _max_ts(self._watermark, updated_at)
+                self._remove(product_id)
+                if is_active:
+                    self._add(product_id, code, titles)
+            in_sync = active_count == len(self._products)
+
+        if not in_sync:
+            self.load()  # товари видаляли — дельта за updated_at цього не бачить
+
+    def suggest(self, prefix: str, lang: str, limit: int) -> List[dict]:
+        prefix = prefix.strip().casefold()
+        found: Dict[int, int] = {}  # product_id -> найкращий kind
+
+        with self._lock:
+            entries = self._entries[lang]
+            i = bisect.bisect_left(entries, (prefix,))
+            scanned = 0
+            while i < len(entries) and scanned < SUGGEST_SCAN_LIMIT:
+                term, kind, product_id = entries[i]
+                if not term.startswith(prefix):
+                    break
+                found[product_id] = min(kind, found.get(product_id, kind))
+                i += 1
+                scanned += 1
+            products = {product_id: self._products[product_id] for product_id in found}
+
+        # спершу збіги з початку назви/коду, далі — коротші назви
+        ranked = sorted(found, key=lambda pid: (found[pid], len(products[pid][1][lang]), products[pid][1][lang], pid))
+        return [
+            {"id": pid, "code": products[pid][0], "title": products[pid][1][lang]}
+            for pid in ranked[:limit]
+        ]
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error(f"Suggest index refresh failed: {e}", exc_info=True)
+            time.sleep(SUGGEST_REFRESH_INTERVAL)
+
+
+_suggest_index: Optional[SuggestIndex] = SuggestIndex() if SUGGEST_INDEX else None
+
+
+@app.route('/products/suggest', methods=['GET'])
+@require_auth
+def suggest_products():
+
+    req_prefix = request.args.get('prefix', '').strip()
+    if not req_prefix:
+        return jsonify({"error": "Missing prefix"}), 400
+    if len(req_prefix) > 100:
+        return jsonify({"error": "Prefix too long"}), 400
+
+    req_lang = request.args.get('lang', DEFAULT_LANG).lower()
+    if req_lang not in VALID_LANGS:
+        req_lang = DEFAULT_LANG
+
+    try:
+        req_limit = min(SUGGEST_MAX_LIMIT, max(1, int(request.args.get('limit', SUGGEST_DEFAULT_LIMIT))))
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
 
-        return jsonify(response), 200
+    if _suggest_index is None or not _suggest_index.ready:
+        return jsonify({"error": "Suggest index is not ready"}), 503
 
-    except Exception as e:
-        log.error(f"Error in get_products: {e}", exc_info=True)
-        return jsonify({"error": "Internal server error"}), 500
-    finally:
-        if conn:
-            conn.close()
-    
+    suggestions = _suggest_index.suggest(req_prefix, req_lang, req_limit)
+    return jsonify({
+        "prefix"        : req_prefix,
+        "count"         : len(suggestions),
+        "suggestions"   : suggestions
+    }), 200
 
 
 
@@ -494,6 +2436,154 @@ def _parse_product_str(product_str: str) -> Tuple[Optional[int], Optional[str]]:
     return product_id, subprod_code
 
 
+# Валідатори GET /products/<product_str> рахуються з тих самих полів і в probe-запиті (умовний запит),
+# і в повному запиті (_query_product_details) — тож ETag відповіді завжди збігається з тим, що перевіряє probe.
+# Кешу валідаторів у пам'яті немає: шляхи зображень не входять у версію каталогу, і кеш віддавав би 304 на змінене тіло.
+_IMAGE_SIG_SQL = """
+    (SELECT string_agg(i.id || ':' || COALESCE(i.image_path, ''), ',' ORDER BY i.is_primary DESC, i.id)
+       FROM public.images i
+      WHERE i.product_code = p.code AND COALESCE(i.subprod_code, '') IN ('', %s))
+"""
+
+
+def _product_validator(product_id: int, subprod_code: Optional[str], lang: str, currency: str,
+                       product_updated: Optional[datetime], price_updated: Optional[datetime],
+                       image_sig: Optional[str]) -> Tuple[str, Optional[datetime]]:
+    """(etag, last_modified)"""
+    stamps = [_as_utc(ts) for ts in (product_updated, price_updated) if ts is not None]
+    last_modified = max(stamps) if stamps else None
+
+    raw = repr((product_id, subprod_code, lang, currency, product_updated, price_updated, image_sig))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest(), last_modified
+
+
+def _probe_product_validator(conn, product_id: int, subprod_code: Optional[str],
+                             lang: str, currency: str) -> Optional[Tuple[str, Optional[datetime]]]:
+    """
+    Дешевий запит: лише мітки змін товару й ціни та шляхи зображень (без BYTEA і без join категорій).
+    Возвращает (etag, last_modified) или None, если товара нет.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT
+                p.updated_at,
+                pl.updated_at,
+                {_IMAGE_SIG_SQL}
+            FROM products p
+            LEFT JOIN price_list pl ON p.code = pl.product_code AND pl.currency_code = %s
+                                   AND COALESCE(pl.subprod_code, '') = ''
+            WHERE p.id = %s AND p.is_active = TRUE
+        """, (subprod_code or '', currency, product_id))
+        row = cur.fetchone()
+
+    if not row:
+        return None
+    return _product_validator(product_id, subprod_code, lang, currency, *row)
+
+
+def _as_utc(ts: datetime) -> datetime:
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts.astimezone(timezone.utc)
+
+
+def _is_not_modified(etag: str, last_modified: Optional[datetime]) -> bool:
+    # If-None-Match має пріоритет над If-Modified-Since (RFC 9110)
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    return since is not None and last_modified is not None and last_modified.replace(microsecond=0) <= since
+
+
+def _with_validators(resp: Response, etag: str, last_modified: Optional[datetime]) -> Response:
+    resp.set_etag(etag)
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+
+def _product_image_keys(product_code: str, subprod_code: Optional[str]) -> List[ImageKey]:
+    keys: List[ImageKey] = [(product_code, subprod_code)]  # приоритет: subprod_code
+    if subprod_code:
+        keys.append((product_code, None))  # если нет по subprod_code → по основному
+    return keys
+
+
+def _product_detail(row: dict, subprod_code: Optional[str], image_map: ImagePathMap) -> dict:
+    """Відповідь /products/<product_str> з рядка товару та карти зображень."""
+    product_code = row['product_code']
+
+    # Определяем, какое изображение главное
+    main_key = (product_code, subprod_code)
+    fallback_key = (product_code, None)
+
+    # Главное изображение
+    main_image = image_map.get(main_key) or image_map.get(fallback_key, '')
+
+    # Все изображения (основные + вариативные)
+    all_images = []
+    # Основное
+    if image_map.get(fallback_key):
+        all_images.append(image_map[fallback_key])
+    # Вариативное (если есть)
+    if subprod_code and image_map.get(main_key):
+        all_images.append(image_map[main_key])
+
+    response = {
+        "id": row['id'],
+        "product_code": product_code,
+        "category_id": row['category_id'],
+        "category": row['category'],
+        "active": row['is_active'],
+        "title": row['title'] or '',
+        "description": row['description'] or '',
+        "price": float(row['price']),
+        "quantity": int(row['quantity']),
+        "image": main_image,
+        "images": all_images,
+        "updated_at": row['updated_at'].isoformat() if row['updated_at'] else None
+    }
+
+    if subprod_code:
+        response["subprod_code"] = subprod_code
+    return response
+
+
+def _query_product_details(conn, lang: str, currency: str, product_ids: List[int],
+                           subprod_code: Optional[str] = None) -> Dict[int, dict]:
+    """
+    Рядки для _product_detail одним запитом: product_id -> row (лише активні товари).
+    price_updated_at та image_sig (для subprod_code) — поля для _product_validator.
+    """
+    col_title = f"title_{lang}"
+    col_descr = f"descr_{lang}"
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f"""
+            SELECT 
+                p.id,
+                p.code AS product_code,
+                c.id AS category_id,
+                c.code AS category,
+                p.is_active,
+                p.{col_title} AS title,
+                p.{col_descr} AS description,
+                p.updated_at,
+                COALESCE(pl.price, 0) AS price,
+                COALESCE(pl.stock_quantity, 0) AS quantity,
+                pl.updated_at AS price_updated_at,
+                {_IMAGE_SIG_SQL} AS image_sig,
+                img.image_path,
+                COALESCE(img.has_data, FALSE) AS image_pending
+            FROM products p
+            LEFT JOIN categories c ON p.category_code = c.code
+            LEFT JOIN price_list pl ON p.code = pl.product_code AND pl.currency_code = %s
+                                   AND COALESCE(pl.subprod_code, '') = ''  -- базова ціна, як у CatalogEngine
+            {PRIMARY_IMAGE_LATERAL}
+            WHERE p.id = ANY(%s) AND p.is_active = TRUE
+        """, (subprod_code or '', currency, list(product_ids)))
+        return {row['id']: row for row in cur.fetchall()}
+
+
 @app.route('/products/<string:product_str>', methods=['GET'])
 @require_auth
 def get_product(product_str: str):
@@ -516,92 +2606,108 @@ def get_product(product_str: str):
     if req_lang not in VALID_LANGS:
         req_lang = DEFAULT_LANG
 
-    col_title = f"title_{req_lang}"
-    col_descr = f"descr_{req_lang}"
+    conditional = bool(request.if_none_match) or request.if_modified_since is not None
 
-    # === 3. Запрос товара (только по product_id) ===
-    conn = None
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-
-        sql = f"""
-            SELECT 
-                p.id,
-                p.code AS product_code,
-                c.id AS category_id,
-                c.code AS category,
-                p.is_active,
-                p.{col_title} AS title,
-                p.{col_descr} AS description,
-                p.updated_at,
-                COALESCE(pl.price, 0) AS price,
-                COALESCE(pl.stock_quantity, 0) AS quantity
-            FROM products p
-            LEFT JOIN categories c ON p.category_code = c.code
-            LEFT JOIN price_list pl ON p.code = pl.product_code AND pl.currency_code = %s
-            WHERE p.id = %s AND p.is_active = TRUE
-        """
-        cur.execute(sql, (req_currency, product_id))
-        row = cur.fetchone()
-
-        if not row:
-            return jsonify({"error": "Product not found"}), 404
+        snap = _catalog_snapshot()
+        if snap is not None:
+            # === Каталог у пам'яті: і валідатор, і відповідь — без звернення до БД ===
+            slot = snap.slot_by_id.get(product_id)
+            if slot is None or not snap.active[slot]:
+                return jsonify({"error": "Product not found"}), 404
+
+            validator = snap.validator(slot, subprod_code, req_lang, req_currency)
+            if conditional and _is_not_modified(*validator):
+                return _with_validators(Response(status=304), *validator)
+
+            response = _product_detail(snap.detail_row(slot, req_lang, req_currency), subprod_code, snap.image_paths)
+            return _with_validators(jsonify(response), *validator)
+
+        with db_connection() as conn:
+            # === 3. Умовний запит: дешевий probe — щоб відповісти 304 без повного запиту ===
+            if conditional:
+                validator = _probe_product_validator(conn, product_id, subprod_code, req_lang, req_currency)
+                if validator is None:
+                    return jsonify({"error": "Product not found"}), 404
+                if _is_not_modified(*validator):
+                    return _with_validators(Response(status=304), *validator)
+
+            # === 4. Запрос товара (только по product_id); валідатор — з того ж рядка ===
+            row = _query_product_details(conn, req_lang, req_currency, [product_id], subprod_code).get(product_id)
+
+            if not row:
+                return jsonify({"error": "Product not found"}), 404
+
+            validator = _product_validator(product_id, subprod_code, req_lang, req_currency,
+                                           row['updated_at'], row['price_updated_at'], row['image_sig'])
+
+            # === 5. Изображения: головне — з того ж запиту, вариативное — через _fetch_image_paths_bulk ===
+            image_map = _primary_image_map([row])
+            if subprod_code:
+                image_map.update(_fetch_image_paths_bulk([(row['product_code'], subprod_code)]))
+
+            # === 6. Формируем ответ ===
+            response = _product_detail(row, subprod_code, image_map)
+            return _with_validators(jsonify(response), *validator)
 
-        product_code = row['product_code']
+    except Exception as e:
+        log.error(f"Error in get_product: {e}", exc_info=True)
+        return jsonify({"error": "Internal server error"}), 500
+    
 
-        # === 4. Изображения через _fetch_image_paths_bulk ===
-        # Определяем, какое изображение главное
-        main_key = (product_code, subprod_code)  # приоритет: subprod_code
-        fallback_key = (product_code, None)
 
-        # Запрашиваем оба (или один)
-        image_keys = [main_key]
-        if subprod_code:
-            image_keys.append(fallback_key)  # если нет по subprod_code → по основному
+# --------------------------------------------------------------
+# 📦 Кілька товарів одним запитом: GET /products?ids=1,2,3|VAR
+#    Порядок відповіді = порядок ids; для відсутніх — маркер {"requested", "error"}
+def _get_products_by_ids(ids_arg: str, lang: str, currency: str):
+    requested = [part.strip() for part in ids_arg.split(',') if part.strip()]
+    if len(requested) > MAX_BATCH_IDS:
+        return jsonify({"error": f"Too many ids (max {MAX_BATCH_IDS})"}), 400
 
-        image_map = _fetch_image_paths_bulk(image_keys)
+    parsed = [_parse_product_str(product_str) for product_str in requested]
+    product_ids = list({product_id for product_id, _ in parsed if product_id is not None})
 
-        # Главное изображение
-        main_image = image_map.get(main_key) or image_map.get(fallback_key, '')
+    log.debug(f"    Batch: {len(requested)} requested, {len(product_ids)} distinct ids")
 
-        # Все изображения (основные + вариативные)
-        all_images = []
-        # Основное
-        if image_map.get(fallback_key):
-            all_images.append(image_map[fallback_key])
-        # Вариативное (если есть)
-        if subprod_code and image_map.get(main_key):
-            all_images.append(image_map[main_key])
+    try:
+        snap = _catalog_snapshot()
+        if snap is not None:
+            rows = {}
+            for product_id in product_ids:
+                slot = snap.slot_by_id.get(product_id)
+                if slot is not None and snap.active[slot]:
+                    rows[product_id] = snap.detail_row(slot, lang, currency)
+            image_map = snap.image_paths
+        else:
+            with db_connection() as conn:
+                rows = _query_product_details(conn, lang, currency, product_ids) if product_ids else {}
 
-        # === 5. Формируем ответ ===
-        response = {
-            "id": row['id'],
-            "product_code": product_code,
-            "category_id": row['category_id'],
-            "category": row['category'],
-            "active": row['is_active'],
-            "title": row['title'] or '',
-            "description": row['description'] or '',
-            "price": float(row['price']),
-            "quantity": int(row['quantity']),
-            "image": main_image,
-            "images": all_images,
-            "updated_at": row['updated_at'].isoformat() if row['updated_at'] else None
-        }
+            # Головні зображення прийшли разом з товарами; варіанти — одним викликом
+            image_map = _primary_image_map(list(rows.values()))
+            keys = [(rows[product_id]['product_code'], subprod_code)
+                    for product_id, subprod_code in parsed if subprod_code and product_id in rows]
+            if keys:
+                image_map.update(_fetch_image_paths_bulk(keys))
 
-        if subprod_code:
-            response["subprod_code"] = subprod_code
+        products = []
+        for product_str, (product_id, subprod_code) in zip(requested, parsed):
+            if product_id is None:
+                products.append({"requested": product_str, "error": "Invalid product identifier"})
+            elif product_id not in rows:
+                products.append({"requested": product_str, "error": "Product not found"})
+            else:
+                products.append(_product_detail(rows[product_id], subprod_code, image_map))
 
-        return jsonify(response), 200
+        return jsonify({
+            "currency"  : currency,
+            "count"     : sum(1 for item in products if "error" not in item),
+            "products"  : products
+        }), 200
 
     except Exception as e:
-        log.error(f"Error in get_product: {e}", exc_info=True)
+        log.error(f"Error in products batch: {e}", exc_info=True)
         return jsonify({"error": "Internal server error"}), 500
-    finally:
-        if conn:
-            conn.close()
-    
+
 
 
 # ==============================================================
@@ -613,48 +2719,48 @@ def get_cart():
     # print('request.user_id : ', request.user_id)
 
     # бажана мова, або Українська
-    req_lang = request.args.get('lang', 'ua').lower()
-    if req_lang not in ['ua', 'pl', 'en', 'ru']:
-        req_lang = 'ua'
+    req_lang = request.args.get('lang', DEFAULT_LANG).lower()
+    if req_lang not in VALID_LANGS:
+        req_lang = DEFAULT_LANG
 
-    # бажана валюта, або євро
-    req_currency = request.args.get('currency', 'uah').lower()
+    # бажана валюта
+    req_currency = request.args.get('currency', DEFAULT_CURRENCY).lower()
+    if req_currency not in VALID_CURRENCIES:
+        req_currency = DEFAULT_CURRENCY
 
     # відповідна назва колонок
     col_title = 'title_' + req_lang
     col_descr = 'descr_' + req_lang
 
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        # cur.execute("SELECT id, code, " + col_title + " FROM public.categories ORDER BY id;")
-
-        sql = """
-            select 
-                c.id,
-                c.customer_id,
-                c.product_id,
-                pr.category_id,
-                cat.code,
-                pr.""" + col_title + """ as title,
-                pr.""" + col_descr + """ as description,
-                i.img_data,
-                c.quantity,
-                pl.price,
-                c.quantity * pl.price as summ 
-            from carts c 
-            inner join products pr ON pr.id = c.product_id
-            inner join price_list pl ON pl.product_id = c.product_id AND pl.currency_code = '""" + req_currency + """'
-            inner join categories cat ON cat.id = pr.category_id
-            left join images i ON i.product_id = c.product_id
-            where c.customer_id = """ + str(request.user_id)
-
-        cur.execute(sql)
+        with db_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            # Одне головне зображення на рядок (шлях, без BYTEA) і сума кошика — в тому ж запиті
+            cur.execute(f"""
+                SELECT
+                    c.id,
+                    c.product_id,
+                    cat.code AS category,
+                    p.code AS product_code,
+                    p.{col_title} AS title,
+                    p.{col_descr} AS description,
+                    c.quantity,
+                    COALESCE(pl.price, 0) AS price,
+                    c.quantity * COALESCE(pl.price, 0) AS summ,
+                    SUM(c.quantity * COALESCE(pl.price, 0)) OVER () AS total,
+                    img.image_path,
+                    COALESCE(img.has_data, FALSE) AS image_pending
+                FROM carts c
+                JOIN products p ON p.id = c.product_id
+                JOIN price_list pl ON pl.product_code = p.code AND pl.currency_code = %s
+                                  AND COALESCE(pl.subprod_code, '') = ''  -- лише базова ціна: один рядок на позицію
+                LEFT JOIN categories cat ON cat.code = p.category_code
+                {PRIMARY_IMAGE_LATERAL}
+                WHERE c.customer_id = %s
+                ORDER BY c.id
+            """, (req_currency, request.user_id))
+            rows = cur.fetchall()
 
-        rows = cur.fetchall()
-        rows_count = cur.rowcount
-        cur.close()
-        conn.close()
+            image_map = _primary_image_map(rows)
 
         # Приклад структури що повертаємо:
         # {
@@ -675,27 +2781,22 @@ def get_cart():
         #     ]
         # }
 
-        total_summ = 0
-        productsdata = []
-
-        for row in rows:
-            productsdata.append(
-                {"id": row[2],
-                 "category": row[4],
-                 "title": row[5],
-                 "image": row[7],
-                 "measure": "шт.",
-                 "quantity": row[8],
-                 "price": row[9],
-                 "summ": row[10]
-                 }
-            )
-
-            total_summ = total_summ + row[10]
+        productsdata = [
+            {"id": row['product_id'],
+             "category": row['category'] or '',
+             "title": row['title'] or '',
+             "image": image_map.get((row['product_code'], None), ''),
+             "measure": "шт.",
+             "quantity": row['quantity'],
+             "price": float(row['price']),
+             "summ": float(row['summ'])
+             }
+            for row in rows
+        ]
 
         data = {
-            "count": rows_count,
-            "total": total_summ,
+            "count": len(rows),
+            "total": float(rows[0]['total']) if rows else 0,
             "products": productsdata
         }
 
@@ -719,23 +2820,21 @@ def get_orders():
     req_currency = request.args.get('currency', 'uah').lower()
 
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Запрос с объединением заказов и их позиций
-        cursor.execute("""
-            SELECT 
-                o.id,
-                o.order_date,  
-                o.invoice_date, 
-                o.invoice_number,
-                o.delivery_date, 
-                o.total,
-                o.status
-            FROM orders o
-            WHERE o.customer_id = """ + str(request.user_id) )
-
-        orders = cursor.fetchall()
+        with db_connection() as conn, conn.cursor() as cursor:
+            # Запрос с объединением заказов и их позиций
+            cursor.execute("""
+                SELECT 
+                    o.id,
+                    o.order_date,  
+                    o.invoice_date, 
+                    o.invoice_number,
+                    o.delivery_date, 
+                    o.total,
+                    o.status
+                FROM orders o
+                WHERE o.customer_id = """ + str(request.user_id) )
+
+            orders = cursor.fetchall()
 
         orders_list = []
 
@@ -749,8 +2848,6 @@ def get_orders():
                     "summ"          : ordr[5]
                 })
 
-        cursor.close()
-        conn.close()
         return jsonify(
             {   "count"     : len(orders_list),
                 "orders"    : orders_list,  }), 200
@@ -783,29 +2880,27 @@ def get_order(order_id):
     req_currency = request.args.get('currency', 'uah').lower()
 
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # Запрос с объединением заказов и их позиций
-        cursor.execute("""
-            SELECT 
-                o.id, 
-                o.customer_id, 
-                o.invoice_date, 
-                o.invoice_number, 
-                o.total,
-                o.status,
-                oi.id as order_item_id, 
-                oi.product_id, 
-                oi.quantity, 
-                oi.price,
-                p.""" +col_title+ """ as product_name
-            FROM orders o
-            LEFT JOIN order_items oi ON o.id = oi.order_id
-            LEFT JOIN products p ON p.id = oi.product_id 
-            WHERE o.id = %s """, (order_id,))
-
-        orders = cursor.fetchall()
+        with db_connection() as conn, conn.cursor() as cursor:
+            # Запрос с объединением заказов и их позиций
+            cursor.execute("""
+                SELECT 
+                    o.id, 
+                    o.customer_id, 
+                    o.invoice_date, 
+                    o.invoice_number, 
+                    o.total,
+                    o.status,
+                    oi.id as order_item_id, 
+                    oi.product_id, 
+                    oi.quantity, 
+                    oi.price,
+                    p.""" +col_title+ """ as product_name
+                FROM orders o
+                LEFT JOIN order_items oi ON o.id = oi.order_id
+                LEFT JOIN products p ON p.id = oi.product_id 
+                WHERE o.id = %s """, (order_id,))
+
+            orders = cursor.fetchall()
 
         if orders:
             orders_list = []
@@ -840,8 +2935,6 @@ def get_order(order_id):
                 })
 
             orders_list.append(current_order_data)
-            cursor.close()
-            conn.close()
             return jsonify(
                 {
                     "count": len(orders_list),
@@ -849,8 +2942,6 @@ def get_order(order_id):
 
                 }), 200
 
-        cursor.close()
-        conn.close()
         return jsonify({"message": "No orders found"}), 404
 
     except Exception as e:
@@ -896,114 +2987,108 @@ def create_order():
         if not isinstance(item['quantity'], int) or item['quantity'] <= 0:
             return jsonify({"error": "Quantity must be positive integer"}), 400
 
-    conn = None
     try:
-        conn = get_db_connection()
-        conn.autocommit = False
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        with db_connection() as conn:
+            conn.autocommit = False
+            cur = conn.cursor(cursor_factory=RealDictCursor)
 
-        # --- 1. Отримати поточні ціни ---
-        product_codes = [item['product_code'] for item in items]
-        subprod_codes = {item['product_code']: item.get('subprod_code') for item in items}
+            # --- 1. Отримати поточні ціни ---
+            product_codes = [item['product_code'] for item in items]
+            subprod_codes = {item['product_code']: item.get('subprod_code') for item in items}
 
-        price_sql = """
-            SELECT 
-                product_code,
-                COALESCE(subprod_code, '') AS subprod_code,
-                price,
-                stock_quantity
-            FROM public.price_list
-            WHERE product_code = ANY(%s)
-              AND currency_code = %s
-        """
-        cur.execute(price_sql, (product_codes, currency))
-        price_rows = cur.fetchall()
-
-        if len(price_rows) != len(items):
-            missing = set(product_codes) - {row['product_code'] for row in price_rows}
-            return jsonify({"error": f"Price not found for products: {', '.join(missing)}"}), 404
-
-        # Словник: (product_code, subprod_code) → (price, stock)
-        price_map = {}
-        for row in price_rows:
-            key = (row['product_code'], row['subprod_code'] or None)
-            price_map[key] = (float(row['price']), row['stock_quantity'])
-
-        # --- 2. Перевірка наявності та розрахунок totals ---
-        order_items = []
-        total_sum = 0.0
-
-        for item in items:
-            prod_code = item['product_code']
-            sub_code = item.get('subprod_code')
-            qty = item['quantity']
-            key = (prod_code, sub_code)
-
-            if key not in price_map:
-                return jsonify({"error": f"Price not found for {prod_code}{'|' + sub_code if sub_code else ''}"}), 404
-
-            price, stock = price_map[key]
-            if stock < qty:
-                return jsonify({"error": f"Insufficient stock for {prod_code}: {stock} available, {qty} requested"}), 400
-
-            item_total = price * qty
-            total_sum += item_total
-
-            order_items.append({
-                "product_code": prod_code,
-                "subprod_code": sub_code,
-                "quantity": qty,
-                "price": price,
-                "total": item_total
-            })
-
-        # --- 3. Створити замовлення ---
-        invoice_number = f"INV-{datetime.now().strftime('%Y%m%d%H%M%S')}-{request.user_id}"
-        order_sql = """
-            INSERT INTO public.orders 
-                (customer_id, invoice_date, invoice_number, total, status, order_date)
-            VALUES (%s, CURRENT_TIMESTAMP, %s, %s, %s, CURRENT_TIMESTAMP)
-            RETURNING id
-        """
-        cur.execute(order_sql, (request.user_id, invoice_number, total_sum, 'pending'))
-        order_id = cur.fetchone()['id']
-
-        # --- 4. Додати позиції ---
-        items_insert_sql = """
-            INSERT INTO public.order_items 
-                (order_id, product_code, subprod_code, quantity, price, total)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """
-        for item in order_items:
-            cur.execute(items_insert_sql, (
-                order_id,
-                item['product_code'],
-                item['subprod_code'],
-                item['quantity'],
-                item['price'],
-                item['total']
-            ))
+            price_sql = """
+                SELECT 
+                    product_code,
+                    COALESCE(subprod_code, '') AS subprod_code,
+                    price,
+                    stock_quantity
+                FROM public.price_list
+                WHERE product_code = ANY(%s)
+                  AND currency_code = %s
+            """
+            cur.execute(price_sql, (product_codes, currency))
+            price_rows = cur.fetchall()
+
+            if len(price_rows) != len(items):
+                missing = set(product_codes) - {row['product_code'] for row in price_rows}
+                return jsonify({"error": f"Price not found for products: {', '.join(missing)}"}), 404
+
+            # Словник: (product_code, subprod_code) → (price, stock)
+            price_map = {}
+            for row in price_rows:
+                key = (row['product_code'], row['subprod_code'] or None)
+                price_map[key] = (float(row['price']), row['stock_quantity'])
+
+            # --- 2. Перевірка наявності та розрахунок totals ---
+            order_items = []
+            total_sum = 0.0
+
+            for item in items:
+                prod_code = item['product_code']
+                sub_code = item.get('subprod_code')
+                qty = item['quantity']
+                key = (prod_code, sub_code)
+
+                if key not in price_map:
+                    return jsonify({"error": f"Price not found for {prod_code}{'|' + sub_code if sub_code else ''}"}), 404
+
+                price, stock = price_map[key]
+                if stock < qty:
+                    return jsonify({"error": f"Insufficient stock for {prod_code}: {stock} available, {qty} requested"}), 400
+
+                item_total = price * qty
+                total_sum += item_total
+
+                order_items.append({
+                    "product_code": prod_code,
+                    "subprod_code": sub_code,
+                    "quantity": qty,
+                    "price": price,
+                    "total": item_total
+                })
 
-        conn.commit()
-        log.info(f"Order created: id={order_id}, user={request.user_id}, total={total_sum}")
+            # --- 3. Створити замовлення ---
+            invoice_number = f"INV-{datetime.now().strftime('%Y%m%d%H%M%S')}-{request.user_id}"
+            order_sql = """
+                INSERT INTO public.orders 
+                    (customer_id, invoice_date, invoice_number, total, status, order_date)
+                VALUES (%s, CURRENT_TIMESTAMP, %s, %s, %s, CURRENT_TIMESTAMP)
+                RETURNING id
+            """
+            cur.execute(order_sql, (request.user_id, invoice_number, total_sum, 'pending'))
+            order_id = cur.fetchone()['id']
+
+            # --- 4. Додати позиції ---
+            items_insert_sql = """
+                INSERT INTO public.order_items 
+                    (order_id, product_code, subprod_code, quantity, price, total)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """
+            for item in order_items:
+                cur.execute(items_insert_sql, (
+                    order_id,
+                    item['product_code'],
+                    item['subprod_code'],
+                    item['quantity'],
+                    item['price'],
+                    item['total']
+                ))
 
-        return jsonify({
-            "message": "Order created successfully",
-            "order_id": order_id,
-            "invoice_number": invoice_number,
-            "total": total_sum,
-            "currency": currency,
-            "items_count": len(order_items)
-        }), 201
+            conn.commit()
+            log.info(f"Order created: id={order_id}, user={request.user_id}, total={total_sum}")
+
+            return jsonify({
+                "message": "Order created successfully",
+                "order_id": order_id,
+                "invoice_number": invoice_number,
+                "total": total_sum,
+                "currency": currency,
+                "items_count": len(order_items)
+            }), 201
 
     except Exception as e:
-        if conn:
-            conn.rollback()
         log.error(f"Error creating order: {e}", exc_info=True)
         return jsonify({"error": "Internal server error"}), 500
-    finally:
-        if conn:
-            conn.close()
 
 
 
@@ -1031,16 +3116,6 @@ def get_image_filepath(product_code, subprod_code, image_id):
         print(f"  * get_image_filepath error: No product code specified")
         return ""
 
-    # Подключение к БД
-    try:
-        conn = get_db_connection()
-        conn.autocommit = False  # manual transactions
-        cursor = conn.cursor()
-    except Exception as e:
-        print(f"  * get_image_filepath error: Database connection error: {str(e)}")
-
-    
-    
     # Получение пути изображения
     try:
         where_SP = ""
@@ -1050,11 +3125,9 @@ def get_image_filepath(product_code, subprod_code, image_id):
         if image_id:
             where_ID = " AND id = "+image_id;
 
-        cursor.execute("SELECT id, COALESCE(image_path,'') FROM public.images WHERE product_code = %s" + where_SP + where_ID + ";",  (product_code,) )
-        image_data = cursor.fetchone()
-        
-        cursor.close()
-        conn.close()
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT id, COALESCE(image_path,'') FROM public.images WHERE product_code = %s" + where_SP + where_ID + ";",  (product_code,) )
+            image_data = cursor.fetchone()
 
         image_path = ''
         if image_data:
@@ -1072,8 +3145,6 @@ def get_image_filepath(product_code, subprod_code, image_id):
 
 
     except Exception as e:
-        cursor.close()
-        conn.close()
         print(f"  * get_image_filepath error: Database error (fetching image): {str(e)}")
         return ""
     
@@ -1081,41 +3152,136 @@ def get_image_filepath(product_code, subprod_code, image_id):
 
 # ==============================================================
 # --------------------------------------------------------------
-def save_image_to_file( product_code: str,   subprod_code: Optional[str],   image_id: int,   img_data: bytes ) -> str:
+def _cas_path(digest: str, file_ext: str) -> str:
+    """UPLOAD_FOLDER/cas/ab/cd/<sha256><ext> — два рівні каталогів, щоб не тримати всі файли в одному."""
+    return os.path.join(UPLOAD_FOLDER, "cas", digest[:2], digest[2:4], f"{digest}{file_ext}")
+
+
+def _write_image_file(img_data: bytes) -> Tuple[str, str]:
     """
-    Сохраняет BYTEA в файл и обновляет image_path в БД.
-    Возвращает путь к файлу или ''.
+    Лише запис на диск (без БД). Возвращает (путь, sha256); OSError — якщо не вдалося.
+    Ім'я — хеш вмісту: однаковий вміст пишеться один раз, замінене зображення отримує нове ім'я,
+    тож файл можна кешувати назавжди.
     """
+    # --- 1. Хеш і расширение ---
+    digest = hashlib.sha256(img_data).hexdigest()
+    file_ext = imghdr.what(None, h=img_data)
+    file_ext = f".{file_ext}" if file_ext else ".jpg"
+
+    # --- 2. Вже є в сховищі — нічого не пишемо ---
+    file_path = _cas_path(digest, file_ext)
+    if os.path.exists(file_path):
+        return file_path, digest
+
+    # --- 3. Сохраняем на диск: один писач на файл серед усіх потоків і воркерів хоста ---
+    with _image_write_lock(digest):
+        if not os.path.exists(file_path):  # поки чекали — міг записати інший воркер
+            _atomic_write(file_path, img_data)
+    return file_path, digest
+
+
+def _atomic_write(file_path: str, data: bytes):
+    """Тимчасовий файл у тому ж каталозі + fsync + os.replace: читач бачить або нічого, або весь файл."""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
 
+# Single-flight запису файлу: threading.Lock на ключ у процесі + flock на UPLOAD_FOLDER/.locks/<key>.lock між процесами
+_image_write_locks: Dict[str, list] = {}  # key -> [lock, кількість очікувачів]
+_image_write_locks_guard = threading.Lock()
+
+
+@contextmanager
+def _image_write_lock(key: str):
+    with _image_write_locks_guard:
+        entry = _image_write_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
     try:
-        # --- 1. Определяем расширение ---
-        file_ext = imghdr.what(None, h=img_data)
-        file_ext = f".{file_ext}" if file_ext else ".jpg"
+        with entry[0]:
+            if fcntl is None:
+                yield
+                return
+            lock_dir = os.path.join(UPLOAD_FOLDER, ".locks")
+            os.makedirs(lock_dir, exist_ok=True)
+            with open(os.path.join(lock_dir, f"{key}.lock"), 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    finally:
+        with _image_write_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _image_write_locks[key]
 
-        # --- 2. Формируем путь ---
-        suffix = f"_{subprod_code}" if subprod_code else ""
-        filename = f"{product_code}{suffix}_{image_id}{file_ext}"
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
 
-        # --- 3. Сохраняем на диск ---
-        with open(file_path, "wb") as f:
-            f.write(img_data)
+def _record_stored_images(cur, stored: List[Tuple[int, str, str, int]]) -> List[Tuple[int, str, str, int]]:
+    """
+    stored: [(image_id, path, sha256, size_bytes)] — шляхи в images і маніфест image_blobs
+    (refcount рахує тригер з migrations/008_image_blobs.sql).
+    Рядки маніфесту блокуються до кінця транзакції, і лише потім перевіряється файл:
+    `flask images gc` видаляє файл під тим самим блокуванням, тож img_data обнуляється
+    тільки для файлів, які гарантовано лишаться. Повертає записані елементи stored;
+    решта (файл зник) лишається з img_data і буде записана знову.
+    """
+    blobs = {digest: (digest, path, size) for _, path, digest, size in stored}
+    cur.execute("""
+        SELECT sha256 FROM public.image_blobs WHERE sha256 = ANY(%s) ORDER BY sha256 FOR UPDATE
+    """, (sorted(blobs),))
+    execute_values(cur, """
+        INSERT INTO public.image_blobs AS b (sha256, path, size_bytes) VALUES %s
+        ON CONFLICT (sha256) DO UPDATE
+            SET size_bytes = EXCLUDED.size_bytes, last_seen_at = now()
+    """, [blobs[digest] for digest in sorted(blobs)])
+
+    recorded = [item for item in stored if os.path.exists(item[1])]
+    if len(recorded) < len(stored):
+        log.warning(f"{len(stored) - len(recorded)} image files vanished before recording; img_data kept")
+    if recorded:
+        execute_values(cur, """
+            UPDATE public.images AS i
+            SET image_path = v.path, content_sha256 = v.sha256, img_data = NULL
+            FROM (VALUES %s) AS v(id, path, sha256)
+            WHERE i.id = v.id
+        """, [(image_id, path, digest) for image_id, path, digest, _ in recorded])
+    return recorded
 
-        # --- 4. Обновляем БД ---
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    UPDATE public.images
-                    SET image_path = %s, img_data = NULL
-                    WHERE id = %s
-                """, (file_path, image_id))
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            log.warning(f"DB update failed for image {image_id}: {e}")
-        finally:
-            conn.close()
+
+def save_image_to_file( product_code: str,   subprod_code: Optional[str],   image_id: int,   img_data: bytes ) -> str:
+    """
+    Сохраняет BYTEA в файл и обновляет image_path в БД.
+    Возвращает путь к файлу или ''.
+    """
+
+    try:
+        # --- 1-3. Файл на диску ---
+        file_path, digest = _write_image_file(img_data)
+
+        # --- 4. Обновляем БД (в межах запиту — те саме з'єднання, що й у маршруту) ---
+        with db_connection() as conn:
+            try:
+                with conn.cursor() as cur:
+                    recorded = _record_stored_images(cur, [(image_id, file_path, digest, len(img_data))])
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                log.warning(f"DB update failed for image {image_id}: {e}")
+            else:
+                if not recorded:
+                    return ""
 
         log.debug(f"Image saved: {file_path}")
         return file_path
@@ -1127,10 +3293,46 @@ def save_image_to_file( product_code: str,   subprod_code: Optional[str],   imag
 
 
 
+# Кеш шляхів у процесі: ImageKey -> (stored_at, path або NO_IMAGE_MARKER).
+# Незаписані ще зображення ('' — чекають ImageMaterializer) не кешуються, щоб шлях з'явився одразу.
+_image_path_cache: "OrderedDict[ImageKey, Tuple[float, str]]" = OrderedDict()
+_image_path_cache_lock = threading.Lock()
+
+
+def _image_path_cache_get(keys: List[ImageKey]) -> ImagePathMap:
+    """Свіжі записи кешу для keys; NO_IMAGE_MARKER віддається як ''."""
+    now = time.time()
+    found: ImagePathMap = {}
+    with _image_path_cache_lock:
+        for key in keys:
+            cached = _image_path_cache.get(key)
+            if cached is None:
+                continue
+            if now - cached[0] >= IMAGE_PATH_CACHE_TTL:
+                del _image_path_cache[key]
+                continue
+            _image_path_cache.move_to_end(key)
+            found[key] = '' if cached[1] == NO_IMAGE_MARKER else cached[1]
+    return found
+
+
+def _image_path_cache_put(entries: ImagePathMap):
+    now = time.time()
+    with _image_path_cache_lock:
+        for key, path in entries.items():
+            _image_path_cache[key] = (now, path)
+            _image_path_cache.move_to_end(key)
+        while len(_image_path_cache) > IMAGE_PATH_CACHE_MAX:
+            _image_path_cache.popitem(last=False)
+
+
 def _fetch_image_paths_bulk(  items: List[ImageKey]  ) -> ImagePathMap:
     """
     Возвращает пути к изображениям для списка [(product_code, subprod_code), ...].
-    Сортирует по is_primary DESC.
+    Для каждого ключа берётся головне (is_primary DESC, id).
+    Спершу — кеш процесу; далі для решти:
+    фаза 1 — лише id, шлях і прапорець img_data IS NOT NULL (без BYTEA);
+    фаза 2 (IMAGE_MATERIALIZE=inline) — BYTEA за id серверним курсором і лише для тих, що треба записати.
     """
 
     if not items:
@@ -1138,108 +3340,452 @@ def _fetch_image_paths_bulk(  items: List[ImageKey]  ) -> ImagePathMap:
 
     # Убираем дубли
     unique_items = list(dict.fromkeys(items))
-    conn = None
-    try:
-        conn = get_db_connection()
-        with conn.cursor() as cur:
+    result_map: ImagePathMap = _image_path_cache_get(unique_items)
+    missing = [key for key in unique_items if key not in result_map]
+    if not missing:
+        return result_map
 
-            # --- 1. Формируем запрос: только нужные + с img_data или без пути ---
-            placeholders = ','.join('(%s, %s)' for _ in unique_items)
-            params = [code for code, sub in unique_items for code in [code, sub or '']]
+    try:
+        with db_connection() as conn:
+            # --- 1. Лише метадані: всі рядки для ключів, незалежно від того, чи є вже шлях ---
+            with conn.cursor() as cur:
+                placeholders = ','.join('(%s, %s)' for _ in missing)
+                params = [code for code, sub in missing for code in [code, sub or '']]
+
+                cur.execute(f"""
+                    SELECT DISTINCT ON (product_code, COALESCE(subprod_code, ''))
+                        product_code,
+                        subprod_code,
+                        image_path,
+                        img_data IS NOT NULL AS has_data,
+                        id
+                    FROM public.images
+                    WHERE (product_code, COALESCE(subprod_code, '')) IN ({placeholders})
+                    ORDER BY product_code, COALESCE(subprod_code, ''), is_primary DESC, id
+                """, params)
+                rows = cur.fetchall()
+            _count_image_transfer(rows=len(rows))
+
+            # --- 2. Обрабатываем результаты ---
+            resolved: ImagePathMap = {}         # для кешу: шлях або NO_IMAGE_MARKER
+            to_save: Dict[int, ImageKey] = {}   # id -> key
+            to_mark: List[int] = []             # id без даних і без шляху
+
+            for code, sub, path, has_data, img_id in rows:
+                key: ImageKey = (code, sub if sub else None)
+
+                # Если путь уже есть и не маркер — используем
+                if path and path != NO_IMAGE_MARKER and os.path.exists(path):
+                    result_map[key] = resolved[key] = path
+                elif has_data:
+                    # Есть img_data — нужно сохранить (поки що заглушка)
+                    result_map[key] = ''
+                    to_save[img_id] = key
+                else:
+                    # Нет данных и нет пути → маркер
+                    result_map[key] = ''
+                    resolved[key] = NO_IMAGE_MARKER
+                    if not path:
+                        to_mark.append(img_id)
+
+            # --- 3. Маркери — одним UPDATE ---
+            if to_mark:
+                _mark_no_image(conn, to_mark)
+
+            # --- 4. Сохраняем изображения (або лишаємо це ImageMaterializer) ---
+            if to_save:
+                if IMAGE_MATERIALIZE == "inline":
+                    saved = _materialize_images_inline(conn, to_save)
+                    result_map.update(saved)
+                    resolved.update(saved)
+                else:
+                    _image_materializer.wake()
+
+            # --- 5. Для ключей без записей в images — '' ---
+            for key in missing:
+                if key not in result_map:
+                    result_map[key] = ''
+                    resolved[key] = NO_IMAGE_MARKER
+
+            _image_path_cache_put(resolved)
+            return result_map
 
-            query = f"""
-                SELECT 
-                    product_code,
-                    subprod_code,
-                    image_path,
-                    img_data,
-                    id,
-                    is_primary
-                FROM public.images
-                WHERE (product_code, COALESCE(subprod_code, '')) IN ({placeholders})
-                  AND (
-                    image_path IS NULL OR image_path = '' OR image_path = %s
-                  )
-                ORDER BY is_primary DESC, id
-            """
-            cur.execute(query, params + [NO_IMAGE_MARKER])
-            rows = cur.fetchall()
+    except Exception as e:
+        log.error(f"_fetch_image_paths_bulk error: {e}", exc_info=True)
+        return {item: result_map.get(item, '') for item in unique_items}
 
-        # --- 2. Обрабатываем результаты ---
-        result_map: ImagePathMap = {}
-        to_save = []  # (id, code, sub, img_data)
 
-        for code, sub, path, img_data, img_id, is_primary in rows:
-            key: ImageKey = (code, sub if sub else None)
+def _materialize_images_inline(conn, to_save: Dict[int, ImageKey]) -> ImagePathMap:
+    """
+    Фаза 2: BYTEA лише для вказаних id, серверним курсором (по одному FETCH на пакет, а не все разом).
+    Файли пишуться під час читання, шляхи оновлюються одним UPDATE після закриття курсора.
+    """
+    result_map: ImagePathMap = {}
+    written: List[Tuple[int, str, str, int]] = []
+    try:
+        with conn.cursor(name=f"image_blobs_{secrets.token_hex(4)}") as cur:
+            cur.itersize = IMAGE_WORKER_BATCH
+            # img_data IS NOT NULL — інший воркер міг уже записати файл і обнулити BYTEA
+            cur.execute("SELECT id, img_data FROM public.images WHERE id = ANY(%s) AND img_data IS NOT NULL",
+                        (list(to_save),))
+            for img_id, img_data in cur:
+                if img_data is None:
+                    continue
+                _count_image_transfer(blobs=1, blob_bytes=len(img_data))
+                code, sub = to_save[img_id]
+                try:
+                    path, digest = _write_image_file(bytes(img_data))
+                except OSError as e:
+                    log.warning(f"Failed to save image {code}/{sub} (id={img_id}): {e}")
+                    continue
+                written.append((img_id, path, digest, len(img_data)))
+
+        if written:
+            with conn.cursor() as cur:
+                for img_id, path, _, _ in _record_stored_images(cur, written):
+                    result_map[to_save[img_id]] = path
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        log.warning(f"Inline image materialization failed: {e}")
+    return result_map
 
-            # Если путь уже есть и не маркер — используем
-            if path and path != NO_IMAGE_MARKER and os.path.exists(path):
-                result_map[key] = path
-                continue
 
-            # Если есть img_data — нужно сохранить
-            if img_data:
-                if isinstance(img_data, memoryview):
-                    img_data = img_data.tobytes()
-                to_save.append((img_id, code, sub if sub else None, img_data))
-            else:
-                # Нет данных и нет пути → маркер
-                result_map[key] = ''
-                _mark_no_image(conn, img_id)
-
-        # --- 3. Сохраняем изображения ---
-        for img_id, code, sub, img_data in to_save:
-            key: ImageKey = (code, sub)
-            saved_path = save_image_to_file(code, sub, img_id, img_data)
-            result_map[key] = saved_path or ''
-
-        # --- 4. Для остальных — возвращаем '' (и маркер в БД) ---
-        for code, sub in unique_items:
-            key: ImageKey = (code, sub)
-            if key not in result_map:
-                result_map[key] = ''
-                # Найдём id и пометим
-                img_id = _get_image_id(conn, code, sub)
-                if img_id:
-                    _mark_no_image(conn, img_id)
+# Скільки даних з public.images прочитано за запит: заголовки X-Image-* і рядок у debug-лозі.
+# Поза запитом (фонові потоки) не рахується.
+def _count_image_transfer(rows: int = 0, blobs: int = 0, blob_bytes: int = 0):
+    if not has_request_context():
+        return
+    stats = g.setdefault('_image_transfer', {'rows': 0, 'blobs': 0, 'bytes': 0})
+    stats['rows'] += rows
+    stats['blobs'] += blobs
+    stats['bytes'] += blob_bytes
 
-        return result_map
 
-    except Exception as e:
-        log.error(f"_fetch_image_paths_bulk error: {e}", exc_info=True)
-        return {item: '' for item in unique_items}
-    finally:
-        if conn:
-            conn.close()
+@app.after_request
+def _report_image_transfer(resp: Response) -> Response:
+    stats = g.get('_image_transfer')
+    if stats:
+        resp.headers['X-Image-Rows'] = str(stats['rows'])
+        resp.headers['X-Image-Bytes'] = str(stats['bytes'])
+        log.debug(f"    Images: {stats['rows']} rows, {stats['blobs']} blobs, {stats['bytes']} bytes from DB")
+    return resp
 
 
-def _get_image_id(conn, product_code: str, subprod_code: Optional[str]) -> Optional[int]:
-    """Возвращает id записи или None"""
+def _mark_no_image(conn, image_ids: List[int]):
+    """Ставит __NO_IMAGE__ всем image_ids одним UPDATE"""
     try:
         with conn.cursor() as cur:
             cur.execute("""
-                SELECT id FROM public.images
-                WHERE product_code = %s AND COALESCE(subprod_code, '') = %s
-                LIMIT 1
-            """, (product_code, subprod_code or ''))
-            row = cur.fetchone()
-            return row[0] if row else None
-    except:
-        return None
+                UPDATE public.images SET image_path = %s WHERE id = ANY(%s)
+            """, (NO_IMAGE_MARKER, image_ids))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        log.warning(f"Failed to mark {len(image_ids)} images as missing: {e}")
+    
+
+
+
+# ==============================================================
+# --------------------------------------------------------------
+# 🖼️ Фонове перенесення BYTEA у файли
+#    Маршрути лише читають image_path і віддають '' поки файла немає.
+#    Рядки беруться FOR UPDATE SKIP LOCKED, тож потоки різних web-воркерів
+#    і окремий `flask images worker` не пишуть один і той самий файл двічі.
+class ImageMaterializer:
+
+    def __init__(self):
+        self._wake = threading.Event()
+
+    def wake(self):
+        """Запит помітив незаписане зображення — не чекати IMAGE_WORKER_INTERVAL."""
+        self._wake.set()
+
+    def drain_batch(self, after_id: int = 0) -> Tuple[Optional[int], int]:
+        """Один пакет в одній транзакції: (останній id або None, якщо черга порожня; записано файлів)."""
+        written: List[Tuple[int, str, str, int]] = []
+        with db_connection(shared=False) as conn:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT id, product_code, subprod_code, img_data
+                        FROM public.images
+                        WHERE img_data IS NOT NULL
+                          AND (image_path IS NULL OR image_path = '')
+                          AND id > %s
+                        ORDER BY id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    """, (after_id, IMAGE_WORKER_BATCH))
+                    rows = cur.fetchall()
+
+                    for img_id, code, sub, img_data in rows:
+                        try:
+                            path, digest = _write_image_file(bytes(img_data))
+                        except OSError as e:
+                            log.warning(f"Failed to write image {code}/{sub} (id={img_id}): {e}")
+                            continue
+                        written.append((img_id, path, digest, len(img_data)))
+
+                    if written:
+                        written = _record_stored_images(cur, written)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+        return (rows[-1][0] if rows else None), len(written)
+
+    def drain(self) -> int:
+        """Усі незаписані на цей момент зображення; повертає кількість записаних файлів."""
+        total, after_id = 0, 0
+        while after_id is not None:
+            after_id, written = self.drain_batch(after_id)
+            total += written
+        if total:
+            log.info(f"Image materializer: {total} files written")
+        return total
+
+    def run(self):
+        """Тіло фонового потоку (або `flask images worker`)."""
+        while True:
+            try:
+                if self.drain():
+                    _products_cache.clear()  # у закешованих сторінках ще порожні шляхи
+            except Exception as e:
+                log.error(f"Image materializer failed: {e}", exc_info=True)
+            self._wake.wait(IMAGE_WORKER_INTERVAL)
+            self._wake.clear()
+
+
+_image_materializer = ImageMaterializer()
+
+
+@app.cli.group("images")
+def images_cli():
+    """Обслуговування зображень з public.images."""
+
+
+def _require_shared_image_volume():
+    """
+    Файл, записаний поза web-процесом, web бачить лише на спільному томі, а BYTEA після запису
+    вже обнулено — без IMAGE_SHARED_VOLUME=1 зображення було б втрачене.
+    """
+    if not IMAGE_SHARED_VOLUME:
+        raise click.ClickException(
+            f"UPLOAD_FOLDER ({UPLOAD_FOLDER}) must be a volume shared with the web processes; "
+            f"set IMAGE_SHARED_VOLUME=1 to confirm")
 
 
-def _mark_no_image(conn, image_id: int):
-    """Ставит __NO_IMAGE__"""
+def _materialize_one(row: Tuple[int, bytes]) -> Optional[Tuple[int, str, str, int]]:
+    img_id, img_data = row
     try:
+        path, digest = _write_image_file(bytes(img_data))
+    except OSError as e:
+        log.warning(f"Failed to write image id={img_id}: {e}")
+        return None
+    return img_id, path, digest, len(img_data)
+
+
+@images_cli.command("materialize")
+@click.option("--batch-size", default=500, show_default=True, help="Рядків на FETCH і на коміт.")
+@click.option("--workers", default=4, show_default=True, help="Потоків запису файлів.")
+@click.option("--after-id", default=0, show_default=True, help="Почати після цього id (див. 'last id' у прогресі).")
+@click.option("--limit", default=0, help="Зупинитись після N рядків (0 — без обмеження).")
+def images_materialize_command(batch_size: int, workers: int, after_id: int, limit: int):
+    """
+    Разове перенесення всіх BYTEA з public.images у файли.
+    Кожен пакет комітиться окремо, тож перерваний запуск можна просто повторити:
+    вже записані рядки (img_data IS NULL) більше не вибираються.
+    """
+    _require_shared_image_volume()
+    candidates = """
+        FROM public.images
+        WHERE img_data IS NOT NULL
+          AND (image_path IS NULL OR image_path = '')
+          AND id > %s
+    """
+    started = time.monotonic()
+    written = failed = total_bytes = 0
+    last_id = after_id
+
+    # Читання — серверним курсором на одному з'єднанні, коміти пакетів — на іншому
+    # (коміт закрив би курсор)
+    with db_connection(shared=False) as read_conn, db_connection(shared=False) as write_conn, \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="materialize") as pool:
+        with read_conn.cursor() as cur:
+            cur.execute(f"SELECT count(*) {candidates}", (after_id,))
+            pending = cur.fetchone()[0]
+        if limit:
+            pending = min(pending, limit)
+        click.echo(f"{pending} images to materialize (after id {after_id}, {workers} workers)")
+
+        with read_conn.cursor(name=f"images_materialize_{secrets.token_hex(4)}") as cur:
+            cur.itersize = batch_size
+            cur.execute(f"SELECT id, img_data {candidates} ORDER BY id", (after_id,))
+
+            while True:
+                size = batch_size if not limit else min(batch_size, limit - written - failed)
+                rows = cur.fetchmany(size) if size > 0 else []
+                if not rows:
+                    break
+
+                stored = [item for item in pool.map(_materialize_one, rows) if item is not None]
+                if stored:
+                    try:
+                        with write_conn.cursor() as wcur:
+                            stored = _record_stored_images(wcur, stored)
+                        write_conn.commit()
+                    except Exception:
+                        write_conn.rollback()
+                        raise
+
+                written += len(stored)
+                failed += len(rows) - len(stored)
+                total_bytes += sum(item[3] for item in stored)
+                last_id = rows[-1][0]
+
+                elapsed = max(time.monotonic() - started, 1e-6)
+                click.echo(f"  {written + failed}/{pending} rows, last id {last_id}, "
+                           f"{written / elapsed:.1f} rows/s, {total_bytes / elapsed / 1048576:.1f} MB/s")
+
+    elapsed = time.monotonic() - started
+    click.echo(f"Done: {written} written, {failed} failed, {total_bytes / 1048576:.1f} MB "
+               f"in {elapsed:.1f}s; last id {last_id}")
+
+
+@images_cli.command("gc")
+def images_gc_command():
+    """Видаляє з cas/ файли, на які вже жоден рядок images не посилається (довше за годину)."""
+    _require_shared_image_volume()
+    removed = 0
+    unreferenced = """
+        refcount <= 0 AND last_seen_at < now() - interval '1 hour'
+    """
+    with db_connection(shared=False) as conn:
         with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE public.images SET image_path = %s WHERE id = %s
-            """, (NO_IMAGE_MARKER, image_id))
+            cur.execute(f"SELECT sha256 FROM public.image_blobs WHERE {unreferenced}")
+            candidates = [digest for (digest,) in cur.fetchall()]
         conn.commit()
-    except:
-        conn.rollback()
-    
 
+        # Кожен blob — під _image_write_lock (писачі цього хоста) і блокуванням рядка маніфесту
+        # (_record_stored_images): умову перевіряємо ще раз, а файл видаляємо ДО коміту,
+        # тож писач, що чекав на рядок, побачить, що файлу вже немає, і не обнулить img_data.
+        # Файли .locks/<sha256>.lock не видаляються: інакше два процеси могли б тримати flock на різних inode.
+        for digest in candidates:
+            with _image_write_lock(digest):
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute(f"""
+                            SELECT path FROM public.image_blobs
+                            WHERE sha256 = %s AND {unreferenced}
+                            FOR UPDATE SKIP LOCKED
+                        """, (digest,))
+                        row = cur.fetchone()
+                        if row is None:
+                            conn.rollback()
+                            continue
+                        try:
+                            os.remove(row[0])
+                            removed += 1
+                        except FileNotFoundError:
+                            pass
+                        cur.execute("DELETE FROM public.image_blobs WHERE sha256 = %s", (digest,))
+                    conn.commit()
+                except (OSError, psycopg2.Error) as e:
+                    conn.rollback()
+                    log.warning(f"Image gc failed for {digest}: {e}")
+    log.info(f"Image gc: {removed} files removed")
+
+
+@images_cli.command("worker")
+def images_worker_command():
+    """Окремий процес, що переносить BYTEA у файли (IMAGE_MATERIALIZE=worker для web, спільний том)."""
+    _require_shared_image_volume()
+    log.info("Image worker started")
+    _image_materializer.run()
+
+
+
+# ==============================================================
+# --------------------------------------------------------------
+# 🔎 Мініатюри: /images/<file>?w=200 -> UPLOAD_FOLDER/w200/<file>
+#    Генеруються один раз (пул THUMB_WORKERS потоків, один виклик на файл одночасно),
+#    далі віддаються як звичайні статичні файли.
+_thumb_executor = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix="thumbs")
+_thumb_inflight: Dict[str, Future] = {}
+_thumb_lock = threading.Lock()
+
+
+def _parse_thumb_width(value: Optional[str]) -> Optional[int]:
+    try:
+        width = int(value)
+    except (TypeError, ValueError):
+        return None
+    return width if width in THUMB_WIDTHS else None
+
+
+def _image_relpath(image_path: str) -> str:
+    """Шлях відносно UPLOAD_FOLDER (cas/ab/cd/...), як його приймає /images/<path>."""
+    if image_path.startswith(UPLOAD_FOLDER + os.sep):
+        return os.path.relpath(image_path, UPLOAD_FOLDER)
+    return os.path.basename(image_path)
+
+
+def _thumb_url(image_path: str, width: int) -> str:
+    return f"/images/{_image_relpath(image_path)}?w={width}" if image_path else ''
+
+
+def _thumb_path(filename: str, width: int) -> str:
+    return os.path.join(UPLOAD_FOLDER, f"w{width}", filename)
+
+
+def _make_thumbnail(filename: str, width: int) -> str:
+    """Пише мініатюру атомарно (_atomic_write) і один раз на хост (_image_write_lock)."""
+    target = _thumb_path(filename, width)
+    if os.path.exists(target):
+        return target
+
+    with _image_write_lock(hashlib.sha1(f"w{width}/{filename}".encode('utf-8')).hexdigest()):
+        if os.path.exists(target):
+            return target
+        with Image.open(os.path.join(UPLOAD_FOLDER, filename)) as img:
+            img_format = img.format
+            img.thumbnail((width, width * 10))  # ширина — як задано, висота — пропорційно; не збільшує
+            if img_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            buf = io.BytesIO()
+            img.save(buf, format=img_format, optimize=True)
+        _atomic_write(target, buf.getvalue())
+    log.debug(f"Thumbnail created: {target}")
+    return target
+
+
+def _submit_thumbnail(filename: str, width: int) -> Future:
+    """Single-flight: повторні запити на ту саму мініатюру, поки вона генерується, не ставлять нову задачу."""
+    key = f"{width}/{filename}"
+    with _thumb_lock:
+        future = _thumb_inflight.get(key)
+        if future is None:
+            future = _thumb_executor.submit(_make_thumbnail, filename, width)
+            _thumb_inflight[key] = future
+            future.add_done_callback(lambda f, key=key: _thumbnail_done(key, f))
+        return future
+
+
+def _thumbnail_done(key: str, future: Future):
+    _thumb_inflight.pop(key, None)
+    if future.exception() is not None:
+        log.warning(f"Thumbnail {key} failed: {future.exception()}")
+
+
+def _schedule_thumbnails(image_paths: List[str], width: int):
+    if Image is None:
+        return
+    for path in image_paths:
+        if path and not os.path.exists(_thumb_path(_image_relpath(path), width)):
+            _submit_thumbnail(_image_relpath(path), width)
 
 
 # Новый роут для публичного доступа к изображениям
@@ -1248,7 +3794,49 @@ def get_image(filename):
     # Проверяем, чтобы избежать path traversal (безопасность)
     if '..' in filename or filename.startswith('/'):
         return "Forbidden", 403
-    return send_from_directory('/app/static/images', filename)  # Отдаёт из volume
+
+    if request.args.get('w'):
+        width = _parse_thumb_width(request.args.get('w'))
+        if width is None:
+            return jsonify({"error": f"Invalid width (allowed: {THUMB_WIDTHS})"}), 400
+
+        if Image is not None and os.path.isfile(os.path.join(UPLOAD_FOLDER, filename)):
+            if os.path.exists(_thumb_path(filename, width)):
+                return _send_image(f"w{width}/{filename}")
+
+            # Запит не чекає на генерацію (інакше сплеск нових мініатюр займе всі sync-воркери):
+            # ставимо в чергу й одразу віддаємо оригінал — без довгого кешу, бо за цим URL згодом буде мініатюра
+            _submit_thumbnail(filename, width)
+            resp = _send_image(filename)
+            resp.headers['Cache-Control'] = 'public, no-cache'
+            return resp
+
+    return _send_image(filename)  # Отдаёт из volume
+
+
+# cas/ab/cd/<sha256>.<ext> — див. _write_image_file; і старіші {code}_{id}_{sha256[:16]}.{ext}
+_HASHED_IMAGE_RE = re.compile(r'(/[0-9a-f]{64}|_[0-9a-f]{16})\.[A-Za-z0-9]+$')
+
+
+def _send_image(relpath: str) -> Response:
+    """
+    Файл з UPLOAD_FOLDER: ETag / Last-Modified / Range робить send_from_directory (conditional=True).
+    Імена з хешем вмісту ніколи не змінюють вміст — їх кешуємо на рік; решту — з ревалідацією.
+    IMAGE_SENDFILE передає віддачу байтів фронт-проксі, щоб не займати воркер gunicorn.
+    """
+    immutable = bool(_HASHED_IMAGE_RE.search(relpath))
+
+    if IMAGE_SENDFILE == "x-accel":
+        if not os.path.isfile(os.path.join(UPLOAD_FOLDER, relpath)):
+            return "Not Found", 404
+        resp = Response(mimetype=mimetypes.guess_type(relpath)[0] or 'application/octet-stream')
+        resp.headers['X-Accel-Redirect'] = f"{IMAGE_ACCEL_PREFIX.rstrip('/')}/{relpath}"
+    else:
+        # x-sendfile: send_file сам ставить X-Sendfile замість тіла (USE_X_SENDFILE)
+        resp = send_from_directory(UPLOAD_FOLDER, relpath, conditional=True, etag=True)
+
+    resp.headers['Cache-Control'] = IMAGE_IMMUTABLE_CONTROL if immutable else 'public, no-cache'
+    return resp
 
 
 
@@ -1265,6 +3853,8 @@ if __name__ == "main":
 # Назначение: указывает, как запускать приложение на платформе вроде Railway, Heroku и др.
 # Говорит системе развертывания: «Это веб-приложение, запускай его через python app.py».
 # Ключевое слово web указывает, что это веб-сервис, который слушает HTTP-запросы.
+# Отдельный worker (`flask images worker`) сюда не добавлен: на Railway/Heroku у каждого процесса своя
+# файловая система, и записанные им файлы web не увидит. Только при общем томе и IMAGE_SHARED_VOLUME=1.
 
 # requirements.txt
 # Назначение: список всех Python-зависимостей, нужных для запуска проекта.
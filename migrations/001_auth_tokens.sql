@@ -0,0 +1,13 @@
+-- Видані токени авторизації (TOKEN_PERSIST=postgres).
+-- Зберігається лише sha256 від токена; рядки з минулим expires_at видаляє сам застосунок.
+
+CREATE TABLE IF NOT EXISTS public.auth_tokens (
+    token_hash  BYTEA PRIMARY KEY,
+    user_id     INTEGER NOT NULL,
+    user_login  TEXT NOT NULL,
+    user_name   TEXT NOT NULL,
+    expires_at  TIMESTAMPTZ NOT NULL,
+    created_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS auth_tokens_expires_at_idx ON public.auth_tokens (expires_at);
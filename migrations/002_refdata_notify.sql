@@ -0,0 +1,19 @@
+-- Повідомлення воркерам про зміну довідників: кеш /languages і /currencies скидається по NOTIFY.
+-- Назва каналу має збігатися з REFDATA_CHANNEL (за замовчуванням refdata_changed).
+
+CREATE OR REPLACE FUNCTION public.notify_refdata_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('refdata_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS languages_notify_refdata ON public.languages;
+CREATE TRIGGER languages_notify_refdata
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.languages
+    FOR EACH STATEMENT EXECUTE FUNCTION public.notify_refdata_changed();
+
+DROP TRIGGER IF EXISTS currencies_notify_refdata ON public.currencies;
+CREATE TRIGGER currencies_notify_refdata
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.currencies
+    FOR EACH STATEMENT EXECUTE FUNCTION public.notify_refdata_changed();
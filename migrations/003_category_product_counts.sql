@@ -0,0 +1,52 @@
+-- Лічильники товарів по категоріях для /categories.
+-- Ведуться тригером на products, тож запит не робить агрегат по всій таблиці.
+
+CREATE TABLE IF NOT EXISTS public.category_product_counts (
+    category_code   TEXT PRIMARY KEY,
+    total_count     INTEGER NOT NULL DEFAULT 0,
+    active_count    INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION public.category_product_counts_apply(
+    p_category TEXT, p_total INTEGER, p_active INTEGER) RETURNS void AS $$
+BEGIN
+    IF p_category IS NULL THEN
+        RETURN;
+    END IF;
+    INSERT INTO public.category_product_counts AS cnt (category_code, total_count, active_count)
+    VALUES (p_category, p_total, p_active)
+    ON CONFLICT (category_code) DO UPDATE
+        SET total_count  = cnt.total_count  + EXCLUDED.total_count,
+            active_count = cnt.active_count + EXCLUDED.active_count;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION public.products_maintain_category_counts() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM public.category_product_counts_apply(
+            OLD.category_code, -1, CASE WHEN OLD.is_active THEN -1 ELSE 0 END);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM public.category_product_counts_apply(
+            NEW.category_code, 1, CASE WHEN NEW.is_active THEN 1 ELSE 0 END);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS products_category_counts ON public.products;
+CREATE TRIGGER products_category_counts
+    AFTER INSERT OR DELETE OR UPDATE OF category_code, is_active ON public.products
+    FOR EACH ROW EXECUTE FUNCTION public.products_maintain_category_counts();
+
+-- Початкове заповнення (і перерахунок, якщо міграцію запускають повторно)
+BEGIN;
+LOCK TABLE public.products IN SHARE MODE;
+TRUNCATE public.category_product_counts;
+INSERT INTO public.category_product_counts (category_code, total_count, active_count)
+SELECT category_code, COUNT(*), COUNT(*) FILTER (WHERE is_active)
+FROM public.products
+WHERE category_code IS NOT NULL
+GROUP BY category_code;
+COMMIT;
@@ -0,0 +1,25 @@
+-- Мітки змін для версії каталогу (кеш /products, умовні GET, інкрементальні оновлення в пам'яті).
+-- products.updated_at уже існує; price_list отримує таку саму колонку.
+-- Обидві оновлюються тригером на кожен UPDATE, незалежно від того, хто змінює рядок.
+
+ALTER TABLE public.price_list ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+CREATE OR REPLACE FUNCTION public.touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := now();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS products_touch_updated_at ON public.products;
+CREATE TRIGGER products_touch_updated_at
+    BEFORE UPDATE ON public.products
+    FOR EACH ROW EXECUTE FUNCTION public.touch_updated_at();
+
+DROP TRIGGER IF EXISTS price_list_touch_updated_at ON public.price_list;
+CREATE TRIGGER price_list_touch_updated_at
+    BEFORE UPDATE ON public.price_list
+    FOR EACH ROW EXECUTE FUNCTION public.touch_updated_at();
+
+CREATE INDEX IF NOT EXISTS products_updated_at_idx   ON public.products (updated_at);
+CREATE INDEX IF NOT EXISTS price_list_updated_at_idx ON public.price_list (updated_at);
@@ -0,0 +1,31 @@
+-- Повнотекстовий пошук /products/search.
+-- Вираз tsvector має буквально збігатися з тим, що будує search_products() в app.py.
+-- Trigram-індекси прискорюють ILIKE '%...%' по назві та ILIKE '...%' по коду.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS products_search_ua_idx ON public.products USING GIN (
+    (setweight(to_tsvector('simple', COALESCE(title_ua, '')), 'A') ||
+     setweight(to_tsvector('simple', COALESCE(descr_ua, '')), 'B'))
+);
+CREATE INDEX IF NOT EXISTS products_title_ua_trgm_idx ON public.products USING GIN (title_ua gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS products_search_pl_idx ON public.products USING GIN (
+    (setweight(to_tsvector('simple', COALESCE(title_pl, '')), 'A') ||
+     setweight(to_tsvector('simple', COALESCE(descr_pl, '')), 'B'))
+);
+CREATE INDEX IF NOT EXISTS products_title_pl_trgm_idx ON public.products USING GIN (title_pl gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS products_search_en_idx ON public.products USING GIN (
+    (setweight(to_tsvector('simple', COALESCE(title_en, '')), 'A') ||
+     setweight(to_tsvector('simple', COALESCE(descr_en, '')), 'B'))
+);
+CREATE INDEX IF NOT EXISTS products_title_en_trgm_idx ON public.products USING GIN (title_en gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS products_search_ru_idx ON public.products USING GIN (
+    (setweight(to_tsvector('simple', COALESCE(title_ru, '')), 'A') ||
+     setweight(to_tsvector('simple', COALESCE(descr_ru, '')), 'B'))
+);
+CREATE INDEX IF NOT EXISTS products_title_ru_trgm_idx ON public.products USING GIN (title_ru gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS products_code_trgm_idx ON public.products USING GIN (code gin_trgm_ops);
@@ -0,0 +1,14 @@
+-- Фільтри /products: min_price / max_price, in_stock, is_variative.
+-- Запит з'єднує price_list по (product_code, currency_code), тож валюта — перша колонка індексів,
+-- а діапазон ціни / залишок читаються з того ж індексу.
+
+CREATE INDEX IF NOT EXISTS price_list_currency_price_idx
+    ON public.price_list (currency_code, price, product_code);
+
+CREATE INDEX IF NOT EXISTS price_list_currency_in_stock_idx
+    ON public.price_list (currency_code, product_code)
+    WHERE stock_quantity > 0;
+
+CREATE INDEX IF NOT EXISTS products_active_variative_idx
+    ON public.products (is_variative, category_code)
+    WHERE is_active = TRUE;
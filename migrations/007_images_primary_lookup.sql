@@ -0,0 +1,6 @@
+-- Головне зображення товару через LEFT JOIN LATERAL (PRIMARY_IMAGE_LATERAL в app.py):
+-- WHERE product_code = ... AND COALESCE(subprod_code, '') = '' ORDER BY is_primary DESC, id LIMIT 1
+-- читається з індексу одним кроком, без сортування.
+
+CREATE INDEX IF NOT EXISTS images_primary_lookup_idx
+    ON public.images (product_code, (COALESCE(subprod_code, '')), is_primary DESC, id);
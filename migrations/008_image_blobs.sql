@@ -0,0 +1,49 @@
+-- Контентно-адресоване сховище зображень: UPLOAD_FOLDER/cas/ab/cd/<sha256><ext>.
+-- Однаковий вміст (напр. фото товару й усіх його варіантів) зберігається один раз.
+-- refcount ведеться тригером на images.content_sha256; файли з refcount = 0
+-- прибирає `flask images gc` після пільгового інтервалу (last_seen_at).
+
+CREATE TABLE IF NOT EXISTS public.image_blobs (
+    sha256          TEXT PRIMARY KEY,
+    path            TEXT NOT NULL,
+    size_bytes      BIGINT,
+    refcount        INTEGER NOT NULL DEFAULT 0,
+    created_at      TIMESTAMPTZ NOT NULL DEFAULT now(),
+    last_seen_at    TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS image_blobs_unreferenced_idx
+    ON public.image_blobs (last_seen_at) WHERE refcount <= 0;
+
+ALTER TABLE public.images ADD COLUMN IF NOT EXISTS content_sha256 TEXT;
+CREATE INDEX IF NOT EXISTS images_content_sha256_idx ON public.images (content_sha256);
+
+CREATE OR REPLACE FUNCTION public.image_blobs_apply(p_sha256 TEXT, p_path TEXT, p_delta INTEGER) RETURNS void AS $$
+BEGIN
+    IF p_sha256 IS NULL THEN
+        RETURN;
+    END IF;
+    INSERT INTO public.image_blobs AS b (sha256, path, refcount)
+    VALUES (p_sha256, COALESCE(p_path, ''), p_delta)
+    ON CONFLICT (sha256) DO UPDATE
+        SET refcount     = b.refcount + EXCLUDED.refcount,
+            last_seen_at = now();
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION public.images_maintain_blob_refcount() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM public.image_blobs_apply(OLD.content_sha256, OLD.image_path, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM public.image_blobs_apply(NEW.content_sha256, NEW.image_path, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS images_blob_refcount ON public.images;
+CREATE TRIGGER images_blob_refcount
+    AFTER INSERT OR DELETE OR UPDATE OF content_sha256 ON public.images
+    FOR EACH ROW EXECUTE FUNCTION public.images_maintain_blob_refcount();
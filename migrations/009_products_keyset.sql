@@ -0,0 +1,13 @@
+-- Keyset-пагінація /products (та /products/export): порядок
+-- COALESCE(category_code, ''), COALESCE(title_<lang>, ''), id серед активних товарів.
+-- Вирази мають буквально збігатися з sort_key у _query_products_rows (app.py),
+-- тоді сторінка — це index scan з LIMIT, а не join і сортування всіх активних товарів.
+
+CREATE INDEX IF NOT EXISTS products_keyset_ua_idx
+    ON public.products ((COALESCE(category_code, '')), (COALESCE(title_ua, '')), id) WHERE is_active = TRUE;
+CREATE INDEX IF NOT EXISTS products_keyset_pl_idx
+    ON public.products ((COALESCE(category_code, '')), (COALESCE(title_pl, '')), id) WHERE is_active = TRUE;
+CREATE INDEX IF NOT EXISTS products_keyset_en_idx
+    ON public.products ((COALESCE(category_code, '')), (COALESCE(title_en, '')), id) WHERE is_active = TRUE;
+CREATE INDEX IF NOT EXISTS products_keyset_ru_idx
+    ON public.products ((COALESCE(category_code, '')), (COALESCE(title_ru, '')), id) WHERE is_active = TRUE;
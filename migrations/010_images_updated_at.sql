@@ -0,0 +1,12 @@
+-- Мітка змін для images: каталог у пам'яті (CATALOG_ENGINE=memory) дочитує шляхи зображень
+-- дельтою за updated_at, а не скануванням усієї таблиці на кожному оновленні.
+-- Оновлюється тим самим тригером, що й products / price_list (004_catalog_updated_at.sql).
+
+ALTER TABLE public.images ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+DROP TRIGGER IF EXISTS images_touch_updated_at ON public.images;
+CREATE TRIGGER images_touch_updated_at
+    BEFORE UPDATE ON public.images
+    FOR EACH ROW EXECUTE FUNCTION public.touch_updated_at();
+
+CREATE INDEX IF NOT EXISTS images_updated_at_idx ON public.images (updated_at);